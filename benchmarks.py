@@ -0,0 +1,306 @@
+"""
+Benchmarks of the functions in functions.py on synthetic WPP2019 shaped data
+
+    python benchmarks.py --countries 200 --periods 14 --indicators 10
+    python benchmarks.py --save-baseline
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import subprocess
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+from functions import *
+
+WPP_HEADER = 16
+BASELINE_PATH = 'benchmarks_baseline.json'
+
+
+def generate_periods(n_periods:int, start:int=1950) -> list:
+    """
+    Generates five year periods in the WPP format
+
+    :param int n_periods: Number of periods
+    :param int start: Starting year of the first period
+    :return: List of periods
+
+    >>> generate_periods(2)
+    ['1950-1955', '1955-1960']
+    """
+    return ['{}-{}'.format(start + 5 * i, start + 5 * (i + 1)) for i in range(n_periods)]
+
+
+def generate_wpp_dataframe(n_countries:int, n_periods:int=14, n_subregions:int=20, seed:int=0,
+                           placeholder_rate:float=0.02) -> pd.DataFrame:
+    """
+    Generates a Dataframe shaped like an ESTIMATES sheet of a WPP2019 file, with the World, Region and Subregion
+    aggregate rows followed by the countries. As in the WPP2019 files the hierarchy only depends on the number of
+    countries and subregions, the seed only changes the values
+
+    :param int n_countries: Number of countries
+    :param int n_periods: Number of period columns
+    :param int n_subregions: Number of subregions
+    :param int seed: Seed of the random generator
+    :param float placeholder_rate: Fraction of the aggregate values replaced with the '...' placeholder
+    :return: Dataframe in the layout returned by form_dataframe
+
+    >>> df = generate_wpp_dataframe(10, 3, 2)
+    >>> df.shape, df['Type'].value_counts()['Country/Area']
+    ((14, 10), 10)
+    """
+    rng = np.random.default_rng(seed)
+    n_subregions = max(1, min(n_subregions, n_countries))
+    n_regions = max(1, n_subregions // 4)
+    names = ['WORLD'] + ['Region {}'.format(i) for i in range(n_regions)] + \
+            ['Subregion {}'.format(i) for i in range(n_subregions)] + \
+            ['Country {:05d}'.format(i) for i in range(n_countries)]
+    types = ['World'] + ['Region'] * n_regions + ['Subregion'] * n_subregions + ['Country/Area'] * n_countries
+    codes = [900] + [1000 + i for i in range(n_regions)] + [2000 + i for i in range(n_subregions)] + \
+            [3000 + i for i in range(n_countries)]
+    parents = [0] + [900] * n_regions + [1000 + i % n_regions for i in range(n_subregions)] + \
+              [2000 + i for i in np.random.default_rng(n_countries).integers(0, n_subregions, n_countries)]
+    values = rng.gamma(2.0, 50.0, size=(len(names), n_periods)).round(3).astype(object)
+    # only the aggregate rows carry placeholders, the country rows are fully numeric
+    placeholders = rng.random(values.shape) < placeholder_rate
+    placeholders[len(names) - n_countries:] = False
+    values[placeholders] = '...'
+    df = pd.DataFrame({'Index': np.arange(1, len(names) + 1),
+                       'Variant': 'Estimates',
+                       'Region, subregion, country or area *': names,
+                       'Notes': np.nan,
+                       'Country code': codes,
+                       'Type': types,
+                       'Parent code': parents})
+    return pd.concat([df, pd.DataFrame(values, columns=generate_periods(n_periods))], axis=1)
+
+
+def generate_wpp_workbook(filepath:str, n_countries:int, n_periods:int=14, seed:int=0) -> str:
+    """
+    Writes a synthetic WPP2019 workbook with the header on line WPP_HEADER of the ESTIMATES sheet
+
+    :param str filepath: Path of the excel file to write
+    :param int n_countries: Number of countries
+    :param int n_periods: Number of periods
+    :param int seed: Seed of the random generator
+    :return: Path of the written file
+    """
+    df = generate_wpp_dataframe(n_countries, n_periods, seed=seed)
+    with pd.ExcelWriter(filepath, engine='openpyxl') as writer:
+        df.to_excel(writer, sheet_name='ESTIMATES', startrow=WPP_HEADER, index=False)
+    return filepath
+
+
+def generate_events(countries:list, periods:list, events_per_country:int=4, seed:int=0) -> pd.DataFrame:
+    """
+    Generates an events table in the layout of events_table.xlsx
+
+    :param list countries: List of countries
+    :param list periods: List of periods
+    :param int events_per_country: Number of events of each country
+    :param int seed: Seed of the random generator
+    :return: Dataframe of events
+    """
+    rng = np.random.default_rng(seed)
+    rows = []
+    for country in countries:
+        for i, period in enumerate(sorted(rng.choice(periods, min(events_per_country, len(periods)),
+                                                     replace=False))):
+            rows.append({'Country': country, 'Year': int(period[:4]) + int(rng.integers(0, 5)), 'Period': period,
+                         'Type': 'Coup', 'Event': '{} event {}'.format(country, i), 'Description': ''})
+    return pd.DataFrame(rows, columns=['Country', 'Year', 'Period', 'Type', 'Event', 'Description'])
+
+
+def generate_consolidated(n_countries:int, n_periods:int=14, n_indicators:int=8, seed:int=0) -> pd.DataFrame:
+    """
+    Generates a consolidated Dataframe with events the way the notebook builds it
+
+    :param int n_countries: Number of countries
+    :param int n_periods: Number of periods
+    :param int n_indicators: Number of indicator columns
+    :param int seed: Seed of the random generator
+    :return: Consolidated Dataframe
+    """
+    frames = []
+    for i in range(n_indicators):
+        df = transform_dataframe(generate_wpp_dataframe(n_countries, n_periods, seed=seed + i), [],
+                                 'indicator_{}'.format(i), 0, 0, '', ' ', False)
+        frames.append(df)
+    consolidated_df = get_finalized_df(get_melted_dataframes(frames), [], report_mismatches=False)
+    events_df = generate_events(consolidated_df['Country'].unique(), generate_periods(n_periods), seed=seed)
+    consolidated_df = consolidated_df.merge(events_df, on=['Country', 'Period'], how='outer')
+    consolidated_df = consolidated_df.iloc[:, np.r_[:3, -4:-1, 3:len(consolidated_df.columns) - 4]]
+    consolidated_df['Year'] = consolidated_df['Year'].astype('Int64').astype(str)
+    consolidated_df.reset_index(inplace=True, drop=True)
+    return consolidated_df
+
+
+def measure(func, *args, repeat:int=3, **kwargs) -> dict:
+    """
+    Measures the wall time and the peak memory allocated by a function call
+
+    :param func: Function to call
+    :param args: Positional arguments of the function
+    :param int repeat: Number of timed calls, the fastest is reported
+    :param kwargs: Keyword arguments of the function
+    :return: Dictionary containing the seconds and the peak memory in MB
+    """
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args, **kwargs)
+        times.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        func(*args, **kwargs)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {'seconds': min(times), 'peak_mb': peak / 2 ** 20}
+
+
+def measure_import(module:str='functions', repeat:int=3) -> dict:
+    """
+    Measures the time and the peak memory of importing a module in fresh interpreters
+
+    :param str module: Module to import
+    :param int repeat: Number of timed imports, the fastest is reported
+    :return: Dictionary containing the seconds, the peak memory in MB and the number of plotting libraries imported
+    """
+    code = ('import sys, json, time, tracemalloc\n'
+            'trace = sys.argv[1] == "1"\n'
+            'if trace: tracemalloc.start()\n'
+            'start = time.perf_counter()\n'
+            'import {module}\n'
+            'seconds = time.perf_counter() - start\n'
+            'peak = tracemalloc.get_traced_memory()[1] if trace else 0\n'
+            'plotting = [name for name in {plotting!r} if name in sys.modules]\n'
+            'print(json.dumps({{"seconds": seconds, "peak_mb": peak / 2 ** 20, "plotting_modules": len(plotting)}}))\n'
+            ).format(module=module, plotting=sorted(PLOTTING_MODULES))
+    cwd = os.path.dirname(os.path.abspath(__file__))
+
+    def run(trace):
+        output = subprocess.run([sys.executable, '-c', code, '1' if trace else '0'], cwd=cwd, check=True,
+                                capture_output=True, text=True).stdout
+        return json.loads(output.strip().splitlines()[-1])
+
+    runs = [run(False) for _ in range(repeat)]
+    result = min(runs, key=lambda measurements: measurements['seconds'])
+    result['peak_mb'] = run(True)['peak_mb']
+    return result
+
+
+def run_suite(n_countries:int=200, n_periods:int=14, n_indicators:int=8, repeat:int=3, plots:bool=True) -> dict:
+    """
+    Runs every benchmark on synthetic data of the given scale
+
+    :param int n_countries: Number of countries
+    :param int n_periods: Number of periods
+    :param int n_indicators: Number of indicator columns
+    :param int repeat: Number of timed calls of each benchmark
+    :param bool plots: Indicating whether to benchmark the headless plotting path
+    :return: Dictionary mapping each benchmark to its measurements
+    """
+    results = {'import_functions': measure_import('functions', repeat)}
+    raw_df = generate_wpp_dataframe(n_countries, n_periods)
+    frames = [transform_dataframe(generate_wpp_dataframe(n_countries, n_periods, seed=i), [],
+                                  'indicator_{}'.format(i), 0, 0, '', ' ', False) for i in range(n_indicators)]
+    melted = get_melted_dataframes(frames)
+    consolidated_df = generate_consolidated(n_countries, n_periods, n_indicators)
+    countries = consolidated_df['Country'].dropna().unique().tolist()
+    indicators = ['indicator_{}'.format(i) for i in range(n_indicators)]
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        workbook = generate_wpp_workbook(os.path.join(tmp_dir, 'wpp.xlsx'), n_countries, n_periods)
+        results['form_dataframe'] = measure(form_dataframe, workbook, 'ESTIMATES', WPP_HEADER, use_cache=False,
+                                            repeat=repeat)
+        form_dataframe(workbook, 'ESTIMATES', WPP_HEADER)
+        results['form_dataframe_cached'] = measure(form_dataframe, workbook, 'ESTIMATES', WPP_HEADER, repeat=repeat)
+        results['transform_dataframe'] = measure(transform_dataframe, raw_df, [], 'indicator', 0, 0, '', ' ', False,
+                                                 repeat=repeat)
+        results['get_finalized_df'] = measure(get_finalized_df, melted, [], report_mismatches=False, repeat=repeat)
+        results['impute_regions'] = measure(impute_regions, consolidated_df, inplace=False, repeat=repeat)
+        results['calculate_percent_change'] = measure(calculate_percent_change, consolidated_df, countries,
+                                                      indicators[:2], indicators[:2], 'Indicator', repeat=repeat)
+        results['calculate_event_changes'] = measure(calculate_event_changes, consolidated_df, indicators,
+                                                     repeat=repeat)
+        results['calculate_correlations'] = measure(calculate_correlations, consolidated_df,
+                                                    methods=['pearson', 'spearman'], lags=[0, 1], split_events=True,
+                                                    repeat=repeat)
+        if plots:
+            jobs = [{'plot': 'correlation', 'country': country,
+                     'params': {'x': indicators[0], 'y': indicators[-1], 'hue': 'Period', 'title': country}}
+                    for country in countries[:5]]
+            results['render_plots'] = measure(render_plots, consolidated_df, jobs, os.path.join(tmp_dir, 'plots'),
+                                              max_workers=1, text_iterations=0, repeat=1)
+    return results
+
+
+def compare_to_baseline(results:dict, baseline:dict, tolerance:float=0.25) -> list:
+    """
+    Lists the benchmarks which are slower or use more memory than the baseline by more than the tolerance
+
+    :param dict results: Results of run_suite
+    :param dict baseline: Results of a previous run_suite
+    :param float tolerance: Allowed relative increase
+    :return: List of messages describing the regressions
+
+    >>> compare_to_baseline({'a': {'seconds': 2.0, 'peak_mb': 1.0}}, {'a': {'seconds': 1.0, 'peak_mb': 1.0}})
+    ['a : seconds 1.0000 -> 2.0000 (+100.0%)']
+    """
+    regressions = []
+    for name, measurements in results.items():
+        for metric, value in measurements.items():
+            reference = baseline.get(name, {}).get(metric)
+            if reference and value > reference * (1 + tolerance):
+                regressions.append('{} : {} {:.4f} -> {:.4f} (+{:.1f}%)'.format(name, metric, reference, value,
+                                                                             (value / reference - 1) * 100))
+    return regressions
+
+
+def main(argv:list=None) -> int:
+    """
+    Runs the benchmark suite from the command line
+
+    :param list argv: Command line arguments
+    :return: Exit code, 1 if a regression against the baseline was found
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--countries', type=int, default=200)
+    parser.add_argument('--periods', type=int, default=14)
+    parser.add_argument('--indicators', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--no-plots', action='store_true')
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+    scale = {'countries': args.countries, 'periods': args.periods, 'indicators': args.indicators}
+    results = run_suite(args.countries, args.periods, args.indicators, args.repeat, not args.no_plots)
+    for name, measurements in results.items():
+        print('{:<28} {:>10.4f} s {:>10.2f} MB'.format(name, measurements['seconds'], measurements['peak_mb']))
+    regressions = []
+    if results['import_functions']['plotting_modules']:
+        regressions.append('import_functions : {} plotting libraries imported at import time'.format(
+            results['import_functions']['plotting_modules']))
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump({'scale': scale, 'results': results}, f, indent=2)
+        print('Baseline saved to {}'.format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get('scale') != scale:
+            print('Baseline was recorded at scale {}, skipping the comparison'.format(baseline.get('scale')))
+        else:
+            regressions += compare_to_baseline(results, baseline['results'], args.tolerance)
+    for regression in regressions:
+        print('Regression {}'.format(regression))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,18 +1,298 @@
+import os
+import sys
+import json
+import time
+import logging
+import functools
+import tracemalloc
+import re
+import inspect
+import pickle
+import glob
+import hashlib
+import contextlib
+import threading
+from concurrent.futures import ProcessPoolExecutor
 import pandas as pd
 import numpy as np
-import matplotlib.pyplot as plt
-import seaborn as sns
-from colour import Color
-from matplotlib.patches import Patch
-from adjustText import adjust_text
 
-def form_dataframe(filepath:str, sheet:str, header:int) -> pd.DataFrame:
+WPP_NA_VALUES = ['...', '…', '-', '']
+LABEL_COLUMNS = ['Country', 'Region', 'Variant', 'Type', 'Event', 'Year']
+# columns preceding the values in every WPP2019 sheet, always read by streamed loads since transform_dataframe uses them
+WPP_LABEL_COLUMNS = ['Index', 'Variant', 'Region, subregion, country or area *', 'Notes', 'Country code', 'Type',
+                     'Parent code']
+CACHE_DIR_NAME = '.cache'
+CACHE_MAX_BYTES = 512 * 1024 * 1024
+# kinds of the values of the object columns stored in the Feather cache, see _encode_object_columns
+CACHE_KIND_NAN, CACHE_KIND_TEXT, CACHE_KIND_INT, CACHE_KIND_FLOAT = 0, 1, 2, 3
+CACHE_METADATA_KEY = b'wpp_object_columns'
+# part of the cache keys, so that the entries of an older layout are replaced instead of read
+CACHE_FORMAT_VERSION = 2
+PIPELINE_CACHE_DIR = '.pipeline_cache'
+_instrumentation = {'enabled': False, 'sinks': [], 'trace_memory': False}
+# nesting depth of the instrumented calls, per thread so that concurrent calls do not share it
+_instrumentation_depth = threading.local()
+# outermost calls traced with tracemalloc at the moment, shared by every thread since tracemalloc is process-wide
+_memory_tracing = {'lock': threading.Lock(), 'calls': [], 'started': False}
+_cache_stats = {'hits': 0, 'misses': 0}
+# top-level packages of the plotting libraries, imported inside the plotting functions so that the data functions
+# load without them
+PLOTTING_MODULES = ['matplotlib', 'seaborn', 'colour', 'adjustText']
+
+
+def _file_digest(filepath:str, extra:str='') -> str:
+    """
+    Computes the digest of a file from its content, modification time and size
+
+    :param str filepath: Path of the file
+    :param str extra: Additional text included in the digest
+    :return: Hexadecimal digest
+    """
+    stat = os.stat(filepath)
+    digest = hashlib.sha1()
+    with open(filepath, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    digest.update('{}|{}|{}'.format(stat.st_mtime_ns, stat.st_size, extra).encode())
+    return digest.hexdigest()
+
+
+def _cache_path(filepath:str, sheet:str, header:int) -> (str, str):
+    """
+    Builds the cache file stem for a parsed (file, sheet, header) along with the prefix shared by all of its versions
+
+    :param str filepath: Path of excel file
+    :param str sheet: Sheet name present in excel file
+    :param int header: Line number to be considered as header
+    :return: Cache file path without extension and the prefix common to every version of this entry
+    """
+    digest = _file_digest(filepath, '{}|{}'.format(header, CACHE_FORMAT_VERSION))
+    cache_dir = os.path.join(os.path.dirname(os.path.abspath(filepath)), CACHE_DIR_NAME)
+    prefix = os.path.join(cache_dir, '{}-{}-{}-'.format(os.path.basename(filepath), sheet, header))
+    return prefix + digest[:16], prefix
+
+
+def _value_kind(value) -> int:
+    """
+    Classifies a value of an object column read by read_excel for _encode_object_columns
+
+    :param value: Value of the column
+    :return: CACHE_KIND_NAN, CACHE_KIND_TEXT, CACHE_KIND_INT or CACHE_KIND_FLOAT, None for any other value
+    """
+    if isinstance(value, str):
+        return CACHE_KIND_TEXT
+    if isinstance(value, (bool, np.bool_)):
+        return None
+    if isinstance(value, (int, np.integer)):
+        return CACHE_KIND_INT
+    if isinstance(value, (float, np.floating)):
+        return CACHE_KIND_NAN if np.isnan(value) else CACHE_KIND_FLOAT
+    return None
+
+
+def _encode_object_columns(df:pd.DataFrame) -> (pd.DataFrame, dict):
+    """
+    Splits every object column, e.g. the WPP period columns mixing '...' with numbers, into a float column holding its
+    numbers, a string column holding its text and an int8 column holding the kind of each value, which Arrow can store
+
+    :param pd.DataFrame df: Dataframe read by read_excel
+    :return: Encoded Dataframe and the mapping from every object column to its text and kind columns, or None if a
+        column contains values other than text, numbers and NaN
+
+    >>> encoded, columns = _encode_object_columns(pd.DataFrame({'1950': ['...', 2, 0.5, np.nan]}))
+    >>> encoded.dtypes.astype(str).tolist(), columns
+    (['float64', 'object', 'int8'], {'1950': ['__text_0', '__kind_0']})
+    >>> _decode_object_columns(encoded, columns)['1950'].tolist()
+    ['...', 2, 0.5, nan]
+    """
+    encoded, columns = {}, {}
+    for i, column in enumerate(df.columns):
+        values = df[column]
+        if values.dtype != object:
+            encoded[column] = values
+            continue
+        kinds = [_value_kind(value) for value in values]
+        if None in kinds:
+            return None
+        kinds = np.array(kinds, dtype=np.int8)
+        text_column, kind_column = '__text_{}'.format(i), '__kind_{}'.format(i)
+        encoded[column] = values.where(np.isin(kinds, [CACHE_KIND_INT, CACHE_KIND_FLOAT])).astype(float)
+        encoded[text_column] = values.where(kinds == CACHE_KIND_TEXT)
+        encoded[kind_column] = kinds
+        columns[column] = [text_column, kind_column]
+    return pd.DataFrame(encoded, index=df.index), columns
+
+
+def _decode_object_columns(df:pd.DataFrame, columns:dict) -> pd.DataFrame:
+    """
+    Restores the object columns split by _encode_object_columns
+
+    :param pd.DataFrame df: Encoded Dataframe
+    :param dict columns: Mapping from every object column to its text and kind columns
+    :return: Dataframe with the values and types read by read_excel
+    """
+    for column, (text_column, kind_column) in columns.items():
+        kinds = df[kind_column].to_numpy()
+        numbers = df[column].to_numpy()
+        values = numbers.astype(object)
+        ints = kinds == CACHE_KIND_INT
+        values[ints] = numbers[ints].astype(np.int64).astype(object)
+        text = kinds == CACHE_KIND_TEXT
+        values[text] = df[text_column].to_numpy()[text]
+        df[column] = values
+    return df.drop(columns=[name for pair in columns.values() for name in pair])
+
+
+def _write_feather(df:pd.DataFrame, path:str) -> bool:
+    """
+    Writes a Dataframe read by read_excel as Feather, its object columns being encoded by _encode_object_columns and
+    their mapping kept in the schema metadata
+
+    :param pd.DataFrame df: Dataframe to be written
+    :param str path: File path
+    :return: False if pyarrow is missing or the Dataframe cannot be encoded, True otherwise
+    """
+    try:
+        import pyarrow as pa
+        from pyarrow import feather
+    except ImportError:
+        return False
+    if not all(isinstance(column, str) for column in df.columns) or not df.index.equals(pd.RangeIndex(len(df))):
+        return False
+    encoded = _encode_object_columns(df)
+    if encoded is None:
+        return False
+    encoded_df, columns = encoded
+    table = pa.Table.from_pandas(encoded_df, preserve_index=False)
+    metadata = dict(table.schema.metadata or {})
+    metadata[CACHE_METADATA_KEY] = json.dumps(columns).encode()
+    feather.write_feather(table.replace_schema_metadata(metadata), path)
+    return True
+
+
+def _read_feather(path:str) -> pd.DataFrame:
+    """
+    Reads a Dataframe written by _write_feather
+
+    :param str path: File path
+    :return: Dataframe with the values and types read by read_excel
+    """
+    from pyarrow import feather
+    table = feather.read_table(path)
+    columns = json.loads((table.schema.metadata or {}).get(CACHE_METADATA_KEY, b'{}'))
+    return _decode_object_columns(table.to_pandas(), columns)
+
+
+def _read_cache(stem:str) -> pd.DataFrame:
+    """
+    Reads a cached Dataframe written by _write_cache, returns None if no entry exists. An entry which cannot be read,
+    e.g. truncated, removed by another process meanwhile or a Feather entry without pyarrow, is deleted and treated
+    as missing
+
+    :param str stem: Cache file path without extension
+    :return: Cached Dataframe or None
+    """
+    for extension, reader in (('.feather', _read_feather), ('.pkl', pd.read_pickle)):
+        if os.path.exists(stem + extension):
+            try:
+                return reader(stem + extension)
+            except Exception:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(stem + extension)
+    return None
+
+
+def _write_cache(df:pd.DataFrame, stem:str, prefix:str) -> None:
+    """
+    Writes a Dataframe to the cache as Feather through _write_feather. Pickle is only a fallback for when pyarrow is
+    not installed or the frame holds values _encode_object_columns cannot store, and should not be relied on for a
+    cache directory shared with untrusted users since loading a pickle can run code. The file is written under a
+    temporary hidden name and moved into place, so an interrupted write never leaves a truncated entry. Older
+    versions of the same entry are removed and the cache is evicted down to CACHE_MAX_BYTES
+
+    :param pd.DataFrame df: Dataframe to be cached
+    :param str stem: Cache file path without extension
+    :param str prefix: Prefix common to every version of this entry
+    :return: None
+    """
+    cache_dir = os.path.dirname(stem)
+    os.makedirs(cache_dir, exist_ok=True)
+    for stale in glob.glob(glob.escape(prefix) + '*'):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(stale)
+    # hidden names are skipped by the globs of the stale removal and of evict_cache in other processes
+    tmp_path = os.path.join(cache_dir, '.tmp-{}-{}'.format(os.getpid(), os.path.basename(stem)))
+    try:
+        extension = '.feather'
+        if not _write_feather(df, tmp_path):
+            df.to_pickle(tmp_path)
+            extension = '.pkl'
+        os.replace(tmp_path, stem + extension)
+    finally:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(tmp_path)
+    evict_cache(cache_dir)
+
+
+def evict_cache(cache_dir:str, max_bytes:int=None) -> list:
+    """
+    Removes the least recently used cache files until the total size of the cache is below max_bytes. Files removed
+    by another process meanwhile are skipped
+
+    :param str cache_dir: Cache directory
+    :param int max_bytes: Maximum total size of the cache in bytes, defaults to CACHE_MAX_BYTES
+    :return: List of removed files
+    """
+    if max_bytes is None:
+        max_bytes = CACHE_MAX_BYTES
+    entries = []
+    for path in glob.glob(os.path.join(cache_dir, '*')):
+        with contextlib.suppress(FileNotFoundError):
+            entries.append((os.stat(path), path))
+    entries.sort(key=lambda entry: max(entry[0].st_atime, entry[0].st_mtime))
+    total = sum(stat.st_size for stat, _ in entries)
+    removed = []
+    for stat, path in entries:
+        if total <= max_bytes:
+            break
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(path)
+            removed.append(path)
+        total -= stat.st_size
+    return removed
+
+
+def cache_stats(reset:bool=False) -> dict:
+    """
+    Returns the number of cache hits and misses of form_dataframe
+
+    :param bool reset: Indicating whether to reset the counters after reading them
+    :return: Dictionary containing the hits and misses
+
+    >>> cache_stats(reset=True) # doctest: +ELLIPSIS
+    {'hits': ..., 'misses': ...}
+    >>> cache_stats()
+    {'hits': 0, 'misses': 0}
+    """
+    stats = dict(_cache_stats)
+    if reset:
+        _cache_stats['hits'], _cache_stats['misses'] = 0, 0
+    return stats
+
+
+def form_dataframe(filepath:str, sheet:str, header:int, use_cache:bool=True, stream:bool=False, countries:list=None,
+                   columns:list=None) -> pd.DataFrame:
     """
     Reads a excel file and returns the Dataframe
 
     :param str filepath: Path of excel file
     :param str sheet: Sheet name present in excel file
     :param int header: Line number to be considered as header
+    :param bool use_cache: Indicating whether to use the on-disk cache next to the excel file
+    :param bool stream: Indicating whether to read the rows of countries and the columns with stream_dataframe
+        instead of the whole sheet, bypassing the cache, which lowers the peak memory of large workbooks
+    :param list countries: List of countries to keep when streaming, see stream_dataframe
+    :param list columns: Columns to keep when streaming, see stream_dataframe
     :return: Dataframe containing the read data
 
     >>> form_dataframe('abc.xslx','Sheet1',0) # doctest: +ELLIPSIS
@@ -31,20 +311,122 @@ def form_dataframe(filepath:str, sheet:str, header:int) -> pd.DataFrame:
 
     >>> df = form_dataframe('data/WPP2019_MORT_F03_1_DEATHS_BOTH_SEXES.xlsx','ESTIMATES',16)
 
+    >>> df = form_dataframe('data/WPP2019_MORT_F03_1_DEATHS_BOTH_SEXES.xlsx','ESTIMATES',16,stream=True,\
+    countries=['Libya'],columns=['Region, subregion, country or area *','Type'])
+    >>> df[df['Type'] == 'Country/Area'].values.tolist()
+    [['Libya', 'Country/Area']]
+
     """
+    if stream:
+        return stream_dataframe(filepath, sheet, header, countries, columns=columns)
+    if not use_cache:
+        try:
+            data = pd.read_excel(filepath, sheet_name=sheet, header=header)
+        except FileNotFoundError:
+            raise FileNotFoundError
+        except Exception as e:
+            raise e
+        return data
     try:
-        data = pd.read_excel(filepath, sheet_name=sheet, header=header)
+        stem, prefix = _cache_path(filepath, sheet, header)
     except FileNotFoundError:
         raise FileNotFoundError
-    except Exception as e:
-        raise e
+    data = _read_cache(stem)
+    if data is not None:
+        _cache_stats['hits'] += 1
+        return data
+    _cache_stats['misses'] += 1
+    data = form_dataframe(filepath, sheet, header, use_cache=False)
+    _write_cache(data, stem, prefix)
     return data
 
+def _convert_cell(value):
+    """
+    Converts an openpyxl cell value the way pandas.read_excel does
+
+    :param value: Cell value
+    :return: Converted value
+    """
+    if value is None or value == '':
+        return np.nan
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def stream_dataframe(filepath:str, sheet:str, header:int, countries:list=None, keep_types:list=None,
+                     columns:list=None) -> pd.DataFrame:
+    """
+    Reads a WPP excel file row by row in read-only mode and only keeps the rows of the given countries, so the full
+    sheet is never loaded into a Dataframe. Countries match every name containing them, as in transform_dataframe
+
+    :param str filepath: Path of excel file
+    :param str sheet: Sheet name present in excel file
+    :param int header: Line number to be considered as header
+    :param list countries: List of countries to keep, every row is kept if not given
+    :param list keep_types: Values of the Type column which are always kept, defaults to ['Subregion'] so that
+        transform_dataframe can attach the regions
+    :param list columns: Columns to keep, every column is kept if not given
+    :return: Dataframe containing the matching rows
+
+    >>> stream_dataframe('abc.xlsx','Sheet1',0) # doctest: +ELLIPSIS
+    Traceback (most recent call last):
+    ...
+    FileNotFoundError...
+    """
+    from openpyxl import load_workbook
+    if keep_types is None:
+        keep_types = ['Subregion']
+    workbook = load_workbook(filepath, read_only=True, data_only=True)
+    try:
+        rows = workbook[sheet].iter_rows(min_row=header + 1, values_only=True)
+        header_row = [_convert_cell(value) if value is not None else 'Unnamed: {}'.format(i)
+                      for i, value in enumerate(next(rows, ()))]
+        while header_row and str(header_row[-1]).startswith('Unnamed: '):
+            header_row.pop()
+        if columns:
+            missing = [column for column in columns if column not in header_row]
+            if missing:
+                raise KeyError('Columns not present in {} : {}'.format(filepath, missing))
+            selected = [header_row.index(column) for column in columns]
+        else:
+            selected = list(range(len(header_row)))
+        name_position = header_row.index('Region, subregion, country or area *') if countries else None
+        type_position = header_row.index('Type') if countries and keep_types else None
+        pattern = re.compile('|'.join(countries)) if countries else None
+        data = []
+        for row in rows:
+            if not any(value is not None for value in row):
+                continue
+            if pattern is not None:
+                name = row[name_position]
+                matched = isinstance(name, str) and pattern.search(name) is not None
+                if not matched and (type_position is None or row[type_position] not in keep_types):
+                    continue
+            data.append([_convert_cell(row[i]) if i < len(row) else np.nan for i in selected])
+    finally:
+        workbook.close()
+    return pd.DataFrame(data, columns=[header_row[i] for i in selected]).infer_objects()
+
+
+def build_region_index(df: pd.DataFrame) -> pd.Series:
+    """
+    Builds the mapping from the code of each subregion to its name. The hierarchy is the same in every WPP2019 file,
+    so the index can be built once and passed to every transform_dataframe call
+
+    :param pd.DataFrame df: Dataframe read from a WPP2019 file
+    :return: Series of subregion names indexed by their country code
+    """
+    subregion_df = df[df['Type'] == 'Subregion']
+    return pd.Series(subregion_df['Region, subregion, country or area *'].to_numpy(),
+                     index=subregion_df['Country code'].to_numpy())
+
+
 def transform_dataframe(df: pd.DataFrame, countries:list, df_name:str, from_column:int, to_column:int, prefix:str, sep:str,
-                        rename_flag:bool) -> pd.DataFrame:
+                        rename_flag:bool, region_index:pd.Series=None) -> pd.DataFrame:
     """
     Returns a transformed dataframe which contains a subset interested countries along with the corresponding region
-    of each of the countries.
+    of each of the countries. Rows are filtered down to the matching countries before the regions are mapped.
 
     :param pd.DataFrame df: Dataframe to transform
     :param list countries: List of countries
@@ -54,10 +436,12 @@ def transform_dataframe(df: pd.DataFrame, countries:list, df_name:str, from_colu
     :param str prefix: Prefix of the renamed columns
     :param str sep: Separator for renamed columns
     :param bool rename_flag: Indicating whether to rename columns
+    :param pd.Series region_index: Mapping from subregion code to name built by build_region_index, built from df if
+        not given
     :return: Transformed DataFrame
 
     >>> transform_dataframe(form_dataframe('data/WPP2019_MORT_F03_1_DEATHS_BOTH_SEXES.xlsx','ESTIMATES',16), ['Iraq','Myanmar','Afghanistan','Libya','Germany','Venezuela'],'mortality_all_gender', 0, 0, '', ' ', False) # doctest: +ELLIPSIS
-         Index    Variant      Country  ...  2010-2015 2015-2020          Region
+       Index    Variant  ... 2015-2020              Region
     ...
 
     >>> transform_dataframe(form_dataframe('data/WPP2019_MORT_F04_1_DEATHS_BY_AGE_BOTH_SEXES.xlsx',\
@@ -80,20 +464,19 @@ def transform_dataframe(df: pd.DataFrame, countries:list, df_name:str, from_colu
     TypeError:...
 
     """
-    # countries_regex_expr='' countries_regex_expr=countries_regex_expr.join(val+'|' if i != len(countries)-1 else
-    # val for i,val in enumerate(countries)) filter=df['Region, subregion, country or area *'].str.contains(
-    # countries_regex_expr,regex=True)
-    sub_region_filter = df['Type'] == 'Subregion'
-    subregion_df = df[sub_region_filter]
-    # df=df[filter]
-    df = df.merge(subregion_df[['Region, subregion, country or area *', 'Country code']], left_on='Parent code',
-                  right_on='Country code', suffixes=('_left', '_right'))
-    df.drop('Country code_right', axis=1, inplace=True)
-    rename_dict = {'Region, subregion, country or area *_left': 'Country',
-                   'Region, subregion, country or area *_right': 'Region',
-                   'Country code_left': 'Country code'}
-    df.rename(columns=rename_dict, inplace=True)
-    df.drop(columns=['Notes'], axis=1, inplace=True)
+    if region_index is None:
+        region_index = build_region_index(df)
+    if countries:
+        # filter on the unique names first so the pattern is not evaluated for every row
+        names = df['Region, subregion, country or area *']
+        unique_names = pd.Series(names.unique(), dtype=object)
+        matched = unique_names[unique_names.str.contains('|'.join(countries), regex=True, na=False)]
+        df = df[names.isin(matched)]
+    regions = df['Parent code'].map(region_index)
+    df = df[regions.notna()]
+    df = df.drop(columns=['Notes']).rename(columns={'Region, subregion, country or area *': 'Country'})
+    df['Region'] = regions[regions.notna()]
+    df = df.reset_index(drop=True)
     df = df.drop_duplicates()
     df = df.infer_objects()
     df.name = df_name
@@ -173,7 +556,7 @@ def get_melted_dataframes(list_df:list) -> list:
 
 
 def display_dataframe(filepath:str, sheet:str, header:str, countries:list, df_name:str, from_column:int=0, to_column:int=0, prefix:str='', sep:str=' ',
-                      rename_flag:bool=False):
+                      rename_flag:bool=False, region_index:pd.Series=None, stream:bool=False, columns:list=None):
     """
     Loads the contents of the given excel file into a transformed and prints the columns containing null values
 
@@ -187,6 +570,11 @@ def display_dataframe(filepath:str, sheet:str, header:str, countries:list, df_na
     :param str prefix: Prefix of the renamed columns
     :param str sep: Separator for renamed columns
     :param bool rename_flag: Indicating whether to rename columns
+    :param pd.Series region_index: Mapping from subregion code to name built by build_region_index, built from the
+        file if not given
+    :param bool stream: Indicating whether to only read the rows of countries with stream_dataframe
+    :param list columns: Value columns to read when streaming, every column if not given. The columns of
+        WPP_LABEL_COLUMNS are always read, so from_column and to_column count from the same position
     :return: Transformed Dataframe
 
     >>> display_dataframe('data/WPP2019_MORT_F03_1_DEATHS_BOTH_SEXES.xlsx',\
@@ -196,37 +584,461 @@ def display_dataframe(filepath:str, sheet:str, header:str, countries:list, df_na
     ...
 
     """
-    df = form_dataframe(filepath, sheet, header)
-    df = transform_dataframe(df, countries, df_name, from_column, to_column, prefix, sep, rename_flag)
+    df = form_dataframe(filepath, sheet, header, stream=stream, countries=countries, columns=_stream_columns(columns))
+    df = transform_dataframe(df, countries, df_name, from_column, to_column, prefix, sep, rename_flag, region_index)
     print('Columns containing null values : {}'.format(check_null_columns(df)))
     return df
 
 
-def get_finalized_df(stat_dataframes:list, stat2_dataframes:list) -> pd.DataFrame:
+def _stream_columns(columns:list) -> list:
+    """
+    Completes the value columns of a streamed load with the columns of WPP_LABEL_COLUMNS used by transform_dataframe
+
+    :param list columns: Value columns, every column if not given
+    :return: Columns to read, None for every column
+    """
+    if columns is None:
+        return None
+    return WPP_LABEL_COLUMNS + [column for column in columns if column not in WPP_LABEL_COLUMNS]
+
+
+def _region_index_entry(filepath:str, sheet:str='ESTIMATES', header:int=16, stream:bool=False,
+                        countries:list=None) -> pd.Series:
+    """
+    Builds the region index of load_dataframes and build_pipeline from a single WPP2019 file
+
+    :param str filepath: Path of excel file
+    :param str sheet: Sheet Name
+    :param int header: Line Number to be considered as header
+    :param bool stream: Indicating whether to only read the subregions and the rows of countries with stream_dataframe
+    :param list countries: List of countries read along with the subregions when streaming
+    :return: Mapping from subregion code to name
     """
-    Merges the acquired list of dataframes using ['Country', 'Region', 'Period']
+    return build_region_index(form_dataframe(filepath, sheet, header, stream=stream, countries=countries,
+                                             columns=WPP_LABEL_COLUMNS if stream else None))
+
+
+def _load_manifest_entry(entry:dict, countries:list, region_index:pd.Series=None) -> (pd.DataFrame, dict):
+    """
+    Loads and transforms a single manifest entry of load_dataframes
+
+    :param dict entry: Manifest entry containing the arguments of display_dataframe
+    :param list countries: List of countries
+    :param pd.Series region_index: Mapping from subregion code to name built by build_region_index
+    :return: Transformed Dataframe and the cache hits and misses of the load, which a worker process only counts in
+        its own copy of the statistics
+    """
+    before = dict(_cache_stats)
+    df = form_dataframe(entry['filepath'], entry.get('sheet', 'ESTIMATES'), entry.get('header', 16),
+                        stream=entry.get('stream', False), countries=countries,
+                        columns=_stream_columns(entry.get('columns')))
+    stats = {key: _cache_stats[key] - before[key] for key in before}
+    return transform_dataframe(df, countries, entry['df_name'], entry.get('from_column', 0), entry.get('to_column', 0),
+                               entry.get('prefix', ''), entry.get('sep', ' '), entry.get('rename_flag', False),
+                               region_index), stats
+
+
+def load_dataframes(manifest:list, countries:list, max_workers:int=None, verbose:bool=True,
+                    stream:bool=False) -> dict:
+    """
+    Loads and transforms several excel files in parallel using a process pool. Each manifest entry is a dictionary
+    with the keys filepath and df_name, and optionally sheet, header, from_column, to_column, prefix, sep,
+    rename_flag, stream and columns which default to the values of display_dataframe. The region index is built once
+    from the first file and shared by every entry. The cache hits and misses of the workers are added to cache_stats
+
+    :param list manifest: List of dictionaries describing the files to load
+    :param list countries: List of countries
+    :param int max_workers: Number of worker processes, defaults to the number of CPUs
+    :param bool verbose: Indicating whether to print the columns containing null values
+    :param bool stream: Default of the stream key of the entries, indicating whether to only read the rows of
+        countries with stream_dataframe
+    :return: Dictionary of transformed Dataframes keyed by df_name in manifest order
+
+    >>> load_dataframes([{'filepath': 'abc.xlsx', 'df_name': 'x'}, {'filepath': 'abc.xlsx', 'df_name': 'x'}], [])
+    Traceback (most recent call last):
+    ...
+    ValueError: Duplicate df_name in manifest : ['x']
+    """
+    names = [entry['df_name'] for entry in manifest]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise ValueError('Duplicate df_name in manifest : {}'.format(duplicates))
+    manifest = [dict({'stream': stream}, **entry) for entry in manifest]
+    region_index = None
+    if manifest:
+        region_index = _region_index_entry(manifest[0]['filepath'], manifest[0].get('sheet', 'ESTIMATES'),
+                                           manifest[0].get('header', 16), manifest[0]['stream'], countries)
+    if max_workers == 1 or len(manifest) < 2:
+        frames = [_load_manifest_entry(entry, countries, region_index)[0] for entry in manifest]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            results = list(executor.map(_load_manifest_entry, manifest, [countries] * len(manifest),
+                                        [region_index] * len(manifest)))
+        frames = [df for df, _ in results]
+        # the workers counted their hits and misses in their own copy of the statistics
+        for _, stats in results:
+            for key, count in stats.items():
+                _cache_stats[key] += count
+    ret_dict = {}
+    for name, df in zip(names, frames):
+        # the name attribute does not survive pickling between processes
+        df.name = name
+        if verbose:
+            print('{} : Columns containing null values : {}'.format(name, check_null_columns(df)))
+        ret_dict[name] = df
+    return ret_dict
+
+
+def get_finalized_df(stat_dataframes:list, stat2_dataframes:list, report_mismatches:bool=True) -> pd.DataFrame:
+    """
+    Merges the acquired list of dataframes using ['Country', 'Region', 'Period']. Every dataframe is indexed once on
+    the key and all of them are aligned in a single concat, keeping only the keys present in every dataframe
     :param list stat_dataframes: List of standard dataframes
     :param list stat2_dataframes: List of dataframes which contain renamed columns
+    :param bool report_mismatches: Indicating whether to print the number of keys of each dataframe which are dropped
     :return: Meged Dataframe
     """
-    main_df = pd.DataFrame()
-    for i, df in enumerate(stat_dataframes):
-        if i < len(stat_dataframes) - 1:
-            if i == 0:
-                main_df = stat_dataframes[i].merge(stat_dataframes[i + 1], on=['Country', 'Region', 'Period'])
-                continue
-            main_df = main_df.merge(stat_dataframes[i + 1], on=['Country', 'Region', 'Period'])
-    for df in stat2_dataframes:
-        main_df = main_df.merge(df.iloc[:, np.r_[2, 6, -1, 7:len(df.columns) - 1]], on=['Country', 'Region', 'Period'])
+    keys = ['Country', 'Region', 'Period']
+    # the melted frames carry their name as value column, the stat2 frames lose .name when sliced
+    names = [getattr(df, 'name', df.columns[-1]) for df in stat_dataframes] + \
+            [getattr(df, 'name', df.columns[-1]) for df in stat2_dataframes]
+    frames = list(stat_dataframes) + [df.iloc[:, np.r_[2, 6, -1, 7:len(df.columns) - 1]] for df in stat2_dataframes]
+    indexed = [df.set_index(keys) for df in frames]
+    value_columns = [column for df in indexed for column in df.columns]
+    if len(value_columns) != len(set(value_columns)) or not all(df.index.is_unique for df in indexed):
+        # overlapping columns or repeated keys need the suffixes and cartesian products of a pairwise merge
+        return _merge_pairwise(frames, keys)
+    keep = np.ones(len(indexed[0]), dtype=bool)
+    for df in indexed[1:]:
+        keep &= indexed[0].index.isin(df.index)
+    common_index = indexed[0].index[keep]
+    if report_mismatches:
+        for df, name in zip(indexed, names):
+            dropped = len(df) - df.index.isin(common_index).sum()
+            if dropped:
+                print('{} : {} keys not present in every dataframe are dropped'.format(name, dropped))
+    main_df = pd.concat([df.reindex(common_index) for df in indexed], axis=1, copy=False)
+    return main_df.reset_index()
+
+
+def _merge_pairwise(frames:list, keys:list) -> pd.DataFrame:
+    """
+    Merges the dataframes one after the other on the given keys
+    :param list frames: List of dataframes
+    :param list keys: Columns to merge on
+    :return: Merged Dataframe
+    """
+    main_df = frames[0]
+    for df in frames[1:]:
+        main_df = main_df.merge(df, on=keys)
     return main_df
 
 
+def consolidate_dataframes(stat_dataframes:list, stat2_dataframes:list, events_df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Builds the consolidated Dataframe from the transformed dataframes and the events table: the standard dataframes
+    are melted, everything is merged with get_finalized_df, the events are attached and the regions imputed
+    :param list stat_dataframes: List of transformed standard dataframes
+    :param list stat2_dataframes: List of dataframes which contain renamed columns
+    :param pd.DataFrame events_df: Events table read from events_table.xlsx
+    :return: Consolidated Dataframe
+    """
+    consolidated_df = get_finalized_df(get_melted_dataframes(stat_dataframes), stat2_dataframes)
+    consolidated_df = consolidated_df.merge(events_df, on=['Country', 'Period'], how='outer', copy=False)
+    consolidated_df = consolidated_df.iloc[:, np.r_[:3, -4:-1, 3:len(consolidated_df.columns) - 4]]
+    consolidated_df['Year'] = consolidated_df['Year'].astype('Int64').astype(str)
+    consolidated_df.reset_index(inplace=True, drop=True)
+    impute_regions(consolidated_df)
+    return consolidated_df
+
+
+def _fingerprint_function(func) -> str:
+    """
+    Fingerprints a function from its name and source, so that stages are rebuilt when their code changes
+    :param func: Function
+    :return: Hexadecimal digest
+    """
+    try:
+        source = inspect.getsource(func)
+    except (OSError, TypeError):
+        source = ''
+    return hashlib.sha1('{}|{}'.format(getattr(func, '__qualname__', repr(func)), source).encode()).hexdigest()
+
+
+@functools.lru_cache(maxsize=None)
+def _code_salt() -> str:
+    """
+    Digest of the source of this module, added to every stage key so that changes to the functions called inside the
+    stages, e.g. transform_dataframe or get_finalized_df, also rebuild the memoized outputs
+    :return: Hexadecimal digest
+    """
+    try:
+        with open(os.path.abspath(__file__), 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return ''
+
+
+def _stage_keys(stages:dict, output_digest=None) -> (list, dict):
+    """
+    Orders the stages so that every stage comes after its inputs and computes the key of each stage from its function,
+    parameters, the keys or file fingerprints of its inputs and the source of this module. An input stage marked with
+    key_by_output contributes the digest of its output instead of its key
+    :param stages: Dictionary of stages, see run_pipeline
+    :param output_digest: Function called with the name and key of a key_by_output stage which returns the digest of
+        its output, the key of the stage is used if not given
+    :return: List of stage names in dependency order and dictionary mapping each stage to its key
+    """
+    order, keys, visiting = [], {}, set()
+
+    def visit(name):
+        if name in keys:
+            return
+        if name in visiting:
+            raise ValueError('Pipeline contains a cycle through {}'.format(name))
+        visiting.add(name)
+        input_keys = []
+        for input_name in stages[name].get('inputs', []):
+            if input_name in stages:
+                visit(input_name)
+                if stages[input_name].get('key_by_output') and output_digest is not None:
+                    input_keys.append(output_digest(input_name, keys[input_name]))
+                else:
+                    input_keys.append(keys[input_name])
+            else:
+                input_keys.append(_file_digest(input_name))
+        params = repr(sorted(stages[name].get('params', {}).items()))
+        keys[name] = hashlib.sha1('|'.join([_code_salt(), _fingerprint_function(stages[name]['func']), params] +
+                                           input_keys).encode()).hexdigest()[:16]
+        visiting.discard(name)
+        order.append(name)
+
+    for stage_name in stages:
+        visit(stage_name)
+    return order, keys
+
+
+def run_pipeline(stages:dict, targets:list=None, cache_dir:str=None, dry_run:bool=False, verbose:bool=True) -> dict:
+    """
+    Runs a pipeline of stages, memoizing the output of every stage on disk. Each stage is a dictionary with the
+    function to call in func, the names of its inputs in inputs and the keyword arguments in params. Inputs which are
+    not stages are file paths. The function is called with the outputs of the input stages (or the file paths) as
+    positional arguments followed by params. A stage is only recomputed when its function, parameters, any of its
+    inputs or the source of this module changed, so editing one workbook only rebuilds the stages downstream of it.
+    The stages using a stage marked with key_by_output are keyed on its output rather than its inputs, so they are
+    only rebuilt when its output changes. Such a stage is computed before the others, even in a dry run
+    :param stages: Dictionary mapping the name of each stage to its definition
+    :param targets: Names of the stages whose output is returned, defaults to every stage
+    :param cache_dir: Directory of the memoized outputs, defaults to PIPELINE_CACHE_DIR
+    :param dry_run: Indicating whether to only report which stages would be rebuilt
+    :param verbose: Indicating whether to print whether each stage is rebuilt or reused
+    :return: Dictionary mapping each target to its output, or each stage to 'rebuild' or 'cached' if dry_run
+
+    >>> plan = run_pipeline({'a': {'func': len, 'params': {}}, 'b': {'func': str, 'inputs': ['a']}},\
+    cache_dir='/nonexistent', dry_run=True)
+    [rebuild] a
+    [rebuild] b
+    """
+    if cache_dir is None:
+        cache_dir = PIPELINE_CACHE_DIR
+    file_names = {name: re.sub(r'[^\w.-]', '_', name) for name in stages}
+    paths, status, outputs = {}, {}, {}
+
+    def locate(name, key):
+        if name not in paths:
+            paths[name] = os.path.join(cache_dir, '{}-{}.pkl'.format(file_names[name], key))
+            status[name] = 'cached' if os.path.exists(paths[name]) else 'rebuild'
+
+    def output_digest(name, key):
+        locate(name, key)
+        output(name)
+        with open(paths[name], 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+
+    def output(name):
+        if name in outputs:
+            return outputs[name]
+        if status[name] == 'cached':
+            try:
+                with open(paths[name], 'rb') as f:
+                    outputs[name] = pickle.load(f)
+                return outputs[name]
+            except (OSError, EOFError, pickle.UnpicklingError):
+                # removed or truncated since the status was computed
+                status[name] = 'rebuild'
+        os.makedirs(cache_dir, exist_ok=True)
+        stage = stages[name]
+        args = [output(input_name) if input_name in stages else input_name for input_name in stage.get('inputs', [])]
+        outputs[name] = stage['func'](*args, **stage.get('params', {}))
+        # only the versions of this stage, not the stages whose names start with the same text, e.g. a and a-b
+        stale_pattern = re.compile(re.escape(file_names[name]) + r'-[0-9a-f]{16}\.pkl')
+        for stale in os.listdir(cache_dir):
+            if stale_pattern.fullmatch(stale):
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(os.path.join(cache_dir, stale))
+        tmp_path = os.path.join(cache_dir, '.tmp-{}-{}'.format(os.getpid(), os.path.basename(paths[name])))
+        with open(tmp_path, 'wb') as f:
+            pickle.dump(outputs[name], f)
+        os.replace(tmp_path, paths[name])
+        return outputs[name]
+
+    order, keys = _stage_keys(stages, output_digest)
+    for name in order:
+        locate(name, keys[name])
+    if verbose:
+        for name in order:
+            print('[{}] {}'.format(status[name], name))
+    if dry_run:
+        return status
+    return {name: output(name) for name in (targets if targets is not None else order)}
+
+
+def _load_stage(filepath:str, region_index:pd.Series, countries:list, df_name:str, **entry) -> pd.DataFrame:
+    """
+    Pipeline stage loading and transforming a single manifest entry of load_dataframes
+    :param filepath: Path of excel file
+    :param region_index: Output of the regions stage
+    :param countries: List of countries
+    :param df_name: Name attribute of the Dataframe
+    :param entry: Remaining arguments of the manifest entry
+    :return: Transformed Dataframe
+    """
+    return _load_manifest_entry(dict(entry, filepath=filepath, df_name=df_name), countries, region_index)[0]
+
+
+def _consolidate_stage(events_df:pd.DataFrame, *frames, names:list, stat2_names:list) -> pd.DataFrame:
+    """
+    Pipeline stage building the consolidated Dataframe with consolidate_dataframes
+    :param events_df: Events table
+    :param frames: Transformed dataframes in the order of names
+    :param names: Names of the dataframes, which are lost when they are memoized
+    :param stat2_names: Names of the dataframes which contain renamed columns
+    :return: Consolidated Dataframe
+    """
+    for df, name in zip(frames, names):
+        df.name = name
+    return consolidate_dataframes([df for df in frames if df.name not in stat2_names],
+                                  [df for df in frames if df.name in stat2_names], events_df)
+
+
+def build_pipeline(manifest:list, events_path:str, countries:list, percent_changes:dict=None,
+                   stat2_names:list=(), stream:bool=False) -> dict:
+    """
+    Builds the stages of the load -> transform_dataframe -> get_finalized_df -> calculate_percent_change chain for
+    run_pipeline. The region index is built once from the first file in the 'regions' stage, keyed by its output so
+    that revising the first file does not rebuild every load. Every manifest entry becomes a 'load:<df_name>' stage
+    using it, the merge becomes the 'consolidated' stage and every entry of
+    percent_changes a 'percent_change:<name>' stage
+    :param manifest: List of dictionaries describing the files to load, see load_dataframes
+    :param events_path: Path of the events table
+    :param countries: List of countries
+    :param percent_changes: Dictionary mapping a name to the keyword arguments of calculate_percent_change
+    :param stat2_names: Names of the manifest entries which contain renamed columns
+    :param stream: Default of the stream key of the entries, indicating whether to only read the rows of countries
+        with stream_dataframe
+    :return: Dictionary of stages
+
+    >>> sorted(build_pipeline([{'filepath': 'a.xlsx', 'df_name': 'a'}], 'events.xlsx', ['Libya'],\
+    {'libya': {'countries': ['Libya'], 'level_two': ['a'], 'calc_attrs': ['a']}}))
+    ['consolidated', 'events', 'load:a', 'percent_change:libya', 'regions']
+    """
+    stages = {'events': {'func': form_dataframe, 'inputs': [events_path], 'params': {'sheet': 'Sheet1', 'header': 0}}}
+    manifest = [dict({'stream': stream}, **entry) for entry in manifest]
+    if manifest:
+        regions_params = {'sheet': manifest[0].get('sheet', 'ESTIMATES'), 'header': manifest[0].get('header', 16)}
+        if manifest[0]['stream']:
+            regions_params.update({'stream': True, 'countries': list(countries)})
+        stages['regions'] = {'func': _region_index_entry, 'inputs': [manifest[0]['filepath']],
+                             'params': regions_params, 'key_by_output': True}
+    for entry in manifest:
+        params = {key: value for key, value in entry.items() if key != 'filepath'}
+        params['countries'] = list(countries)
+        stages['load:' + entry['df_name']] = {'func': _load_stage, 'inputs': [entry['filepath'], 'regions'],
+                                              'params': params}
+    stages['consolidated'] = {'func': _consolidate_stage,
+                              'inputs': ['events'] + ['load:' + entry['df_name'] for entry in manifest],
+                              'params': {'names': [entry['df_name'] for entry in manifest],
+                                         'stat2_names': list(stat2_names)}}
+    for name, params in (percent_changes or {}).items():
+        stages['percent_change:' + name] = {'func': calculate_percent_change, 'inputs': ['consolidated'],
+                                            'params': dict(params)}
+    return stages
+
+
+def replace_placeholders(df:pd.DataFrame) -> pd.DataFrame:
+    """
+    Replaces the WPP placeholders for missing values such as '...' with NaN and converts the object columns which
+    become fully numeric
+
+    :param pd.DataFrame df: Dataframe
+    :return: Dataframe without placeholders
+
+    >>> replace_placeholders(pd.DataFrame({'1950-1955': [0.001, '...'], 'Country': ['A', 'B']})).dtypes.tolist()
+    [dtype('float64'), dtype('O')]
+    """
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        if column in LABEL_COLUMNS or column == 'Period':
+            continue
+        values = df[column].replace(WPP_NA_VALUES, np.nan)
+        converted = pd.to_numeric(values, errors='coerce')
+        if converted.notna().sum() == values.notna().sum():
+            df[column] = converted
+    return df
+
+
+def compact_dataframe(df:pd.DataFrame, period_as_year:bool=False, verbose:bool=True) -> pd.DataFrame:
+    """
+    Reduces the memory used by a transformed or consolidated Dataframe. The label columns become categoricals, Period
+    becomes an ordered categorical or its integer start year, placeholders are replaced with NaN and the numeric
+    columns are downcast wherever no value changes
+
+    :param pd.DataFrame df: Dataframe
+    :param bool period_as_year: Indicating whether to store Period as its start year instead of an ordered categorical
+    :param bool verbose: Indicating whether to print the memory usage before and after
+    :return: Compacted Dataframe
+
+    >>> df = compact_dataframe(pd.DataFrame({'Country': ['A', 'A'], 'Period': ['1955-1960', '1950-1955'],\
+    'value': [1.5, '...'], 'count': [1, 2]}), verbose=False)
+    >>> df.dtypes.astype(str).tolist()
+    ['category', 'category', 'float32', 'int8']
+    >>> df['Period'].min()
+    '1950-1955'
+    """
+    before = df.memory_usage(deep=True).sum()
+    name = getattr(df, 'name', None)
+    df = replace_placeholders(df)
+    for column in df.columns:
+        series = df[column]
+        if column == 'Period':
+            if period_as_year:
+                df[column] = pd.to_numeric(series.astype(str).str[:4], errors='coerce').astype('Int16')
+            else:
+                df[column] = pd.Categorical(series, categories=sorted(series.dropna().unique()), ordered=True)
+        elif column in LABEL_COLUMNS or series.dtype == object:
+            df[column] = series.astype('category')
+        elif pd.api.types.is_integer_dtype(series.dtype):
+            df[column] = pd.to_numeric(series, downcast='integer')
+        elif series.dtype == np.float64:
+            downcast = series.astype(np.float32)
+            if (downcast.astype(np.float64) == series)[series.notna()].all():
+                df[column] = downcast
+    if name is not None:
+        df.name = name
+    if verbose:
+        after = df.memory_usage(deep=True).sum()
+        print('Memory usage : {:.2f} MB -> {:.2f} MB ({:.1f}% saved)'.format(before / 2 ** 20, after / 2 ** 20,
+                                                                         (1 - after / before) * 100 if before else 0))
+    return df
+
+
 def plot_barchart(consolidated_df:pd.DataFrame, country:str, x:str, y:str, title:str, xaxis_label:str="", yaxis_label:str="", title_font_size:str=20,
-                  std_color:str='indigo', color_range:list=None) -> None:
+                  std_color:str='indigo', color_range:list=None, output_path:str=None, event_index:dict=None) -> None:
     """
-    Plots the barchart using the provided attributes and calculates the % change in the y attribute before and after each event
+    Plots the barchart using the provided attributes and prints the % change in the y attribute before and after each event,
+    calculated with calculate_event_changes
 
-    :param pd.DataFrame consolidated_df: Dataframe to be used to plot the barchart
+    :param pd.DataFrame consolidated_df: Dataframe or store built by build_country_store to be used to plot the barchart
     :param str country: The country for which the plot needs to be created
     :param str x: Column of Dataframe to be used as X axis
     :param str y: Column of Dataframe to be used as Y axis
@@ -236,16 +1048,30 @@ def plot_barchart(consolidated_df:pd.DataFrame, country:str, x:str, y:str, title
     :param str title_font_size: Font size of Title
     :param str std_color: Color of the non-event bars
     :param list color_range: Color range of the event bars
+    :param str output_path: File to save the plot to instead of showing it
+    :param dict event_index: Event index built by build_event_index from consolidated_df
     :return: None
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from colour import Color
+    from matplotlib.patches import Patch
     if color_range is None:
         color_range = ['orange', '#cd5700']
-    consolidated_country = consolidated_df.loc[consolidated_df['Country'] == country]
-    consolidated_country.reset_index(inplace=True, drop=True)
-    periods, events, _ = fetch_events_metadata(consolidated_country)
+    if _is_country_store(consolidated_df):
+        consolidated_country = get_country_frame(consolidated_df, country)
+    else:
+        country_filter = consolidated_df['Country'] == country
+        consolidated_country = consolidated_df.loc[country_filter]
+        consolidated_country.reset_index(inplace=True, drop=True)
+    if event_index is None:
+        periods, events, _ = fetch_events_metadata(consolidated_country)
+    else:
+        periods, events, _ = get_country_events(event_index, country)
     red = Color(color_range[0])
-    colors = list(red.range_to(Color(color_range[1]), len(set(periods))))
-    palette = [str(colors[periods.index(val)]) if val in set(periods) else std_color for val in
+    distinct_periods = list(dict.fromkeys(periods))
+    colors = list(red.range_to(Color(color_range[1]), len(distinct_periods)))
+    palette = [str(colors[distinct_periods.index(val)]) if val in set(periods) else std_color for val in
                consolidated_country['Period'].to_list()]
     g = sns.catplot(data=consolidated_country, x=x, y=y, kind='bar', height=10, aspect=1.5, palette=palette)
     # plt.annotate('Gadaffi takes power [1969]', xy=(3,148), xytext=(3,160),
@@ -263,24 +1089,66 @@ def plot_barchart(consolidated_df:pd.DataFrame, country:str, x:str, y:str, title
                     colors))
     patches = [Patch(color=str(v), label=k) for k, v in cmap.items()]
     plt.legend(handles=patches, bbox_to_anchor=(1.04, 0.5), loc='center left', borderaxespad=0)
-    plt.show()
-    # change_dict={} ## might be useful to aggregate all the data of all countries in the future
-    for period, event in zip(periods, events):
-        ref_index = consolidated_country[consolidated_country['Period'] == period].index[0]
-        pre_index, post_index = ref_index - 1, ref_index + 1
-        if pre_index not in consolidated_country.index:
-            # means that this pre index does not exists. In this case we will switch ref index to pre
-            pre_index = ref_index
-        if post_index not in consolidated_country.index:
-            # means that this pre index does not exists. In this case we will switch ref index to pre
-            post_index = ref_index
-        # now calculate the percent change and assign to dict['Event']=val
-        pre_val = consolidated_country.iloc[pre_index].mortality_all_gender
-        post_val = consolidated_country.iloc[post_index].mortality_all_gender
-        change = round(((post_val - pre_val) / pre_val) * 100, 2)
-        print('The {} changed by {}% post {}'.format(yaxis_label, change, event))
-        # change_dict[event]=change
+    _finish_plot(output_path)
+    changes = calculate_event_changes(consolidated_country, [y])
+    for event, change in zip(changes['Event'], changes['Change']):
+        print('The {} changed by {}% post {}'.format(yaxis_label, round(change, 2), event))
+
+
+def calculate_event_changes(consolidated_df:pd.DataFrame, columns:list, countries:list=None) -> pd.DataFrame:
+    """
+    Calculates the % change of the given columns from the row before to the row after every event, for all the events
+    of all the countries at once. As in plot_barchart, the rows of a country are taken in the order of the Dataframe,
+    the reference row of an event is the first row of its period and the reference row itself is used when there is
+    no row before or after it
+    :param consolidated_df: Dataframe or store built by build_country_store
+    :param columns: Columns for which the change needs to be calculated
+    :param countries: Countries for which the changes need to be calculated, all countries if not given
+    :return: Dataframe with one row per event and column
+
+    >>> calculate_event_changes(pd.DataFrame({'Country': ['Libya'] * 3, 'Period': ['1945-1950', '1950-1955', '1955-1960'],\
+    'Event': [None, "Libya's Independence", None], 'Year': [None, '1951', None],\
+    'mortality_all_gender': [200.0, 190.0, 205.0]}), ['mortality_all_gender'])[['Event', 'Previous', 'Next', 'Change']]
+                      Event  Previous   Next  Change
+    0  Libya's Independence     200.0  205.0     2.5
+    """
+    missing = [column for column in columns if column not in (consolidated_df['frame'] if _is_country_store(
+        consolidated_df) else consolidated_df).columns]
+    if missing:
+        raise KeyError('Columns not in the Dataframe: {}'.format(missing))
+    if countries is None:
+        frame = consolidated_df['frame'] if _is_country_store(consolidated_df) else consolidated_df
+        frame = frame[frame['Country'].notna()]
+    else:
+        frame, positions = _country_positions(consolidated_df, countries)
+        frame = frame.take(np.unique(np.concatenate(list(positions.values()) + [np.array([], dtype=np.intp)])))
+    frame = frame.sort_values('Country', kind='mergesort').reset_index(drop=True)
+    rows = np.arange(len(frame))
+    country_codes = pd.factorize(frame['Country'])[0]
+    starts = pd.Series(rows).groupby(country_codes).transform('min').to_numpy()
+    stops = pd.Series(rows).groupby(country_codes).transform('max').to_numpy()
+    references = pd.Series(rows).groupby([frame['Country'].to_numpy(), frame['Period'].to_numpy()],
+                                         sort=False).transform('first').to_numpy()
 
+    event_rows = np.flatnonzero(frame['Event'].notna().to_numpy())
+    references = references[event_rows]
+    previous = np.where(references - 1 >= starts[event_rows], references - 1, references)
+    following = np.where(references + 1 <= stops[event_rows], references + 1, references)
+    values = frame[columns].to_numpy(dtype=float)
+    previous_values, next_values = values[previous].ravel(), values[following].ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        changes = (next_values - previous_values) / previous_values * 100
+    events = frame.iloc[event_rows]
+    return pd.DataFrame({'Country': np.repeat(events['Country'].to_numpy(), len(columns)),
+                         'Period': np.repeat(events['Period'].to_numpy(), len(columns)),
+                         'Event': np.repeat(events['Event'].to_numpy(), len(columns)),
+                         'Year': np.repeat(events['Year'].to_numpy(), len(columns)),
+                         'Previous Period': np.repeat(frame['Period'].to_numpy()[previous], len(columns)),
+                         'Next Period': np.repeat(frame['Period'].to_numpy()[following], len(columns)),
+                         'Column': np.tile(np.array(columns, dtype=object), len(event_rows)),
+                         'Previous': previous_values,
+                         'Next': next_values,
+                         'Change': changes})
 
 
 def fetch_events_metadata(df:pd.DataFrame) -> (list,list,list):
@@ -297,11 +1165,116 @@ def fetch_events_metadata(df:pd.DataFrame) -> (list,list,list):
     return periods, events, years
 
 
+def build_event_index(consolidated_df:pd.DataFrame, events_df:pd.DataFrame=None) -> dict:
+    """
+    Builds an index of the events of every country, so that they do not need to be searched in the Dataframe again.
+    For every country the periods, events, years and row positions in consolidated_df are stored sorted by period,
+    along with the position of the previous and next event period of each event (-1 if there is none) and a mapping
+    from event name to its position in these arrays
+
+    :param pd.DataFrame consolidated_df: Dataframe or store built by build_country_store
+    :param pd.DataFrame events_df: Events table read from events_table.xlsx, the Event column of consolidated_df is
+        used if not given
+    :return: Dictionary mapping each country to its events
+
+    >>> index = build_event_index(pd.DataFrame({'Country': ['A', 'A', 'A', 'B'], \
+    'Period': ['1955-1960', '1950-1955', '1960-1965', '1950-1955'], 'Event': ['y', 'x', np.nan, 'z'], \
+    'Year': ['1957', '1951', np.nan, '1952']}))
+    >>> get_country_events(index, 'A')
+    (['1950-1955', '1955-1960'], ['x', 'y'], ['1951', '1957'])
+    >>> get_neighbour_events(index, 'A', '1955-1960')
+    ('1950-1955', None)
+    """
+    if _is_country_store(consolidated_df):
+        consolidated_df = consolidated_df['frame']
+    rows = consolidated_df[['Country', 'Period', 'Event', 'Year']].reset_index(drop=True)
+    rows['position'] = np.arange(len(rows))
+    if events_df is None:
+        events = rows[rows['Event'].notna()]
+    else:
+        events = events_df[['Country', 'Period', 'Event', 'Year']].astype({'Year': str}).merge(
+            rows.drop(columns='Year').drop_duplicates(['Country', 'Period', 'Event']),
+            on=['Country', 'Period', 'Event'], how='left')
+        events['position'] = events['position'].fillna(-1).astype(np.int64)
+    events = events.sort_values(['Country', 'Period', 'position'], kind='mergesort')
+    event_index = {}
+    for country, country_events in events.groupby('Country', sort=False, observed=True):
+        periods = country_events['Period'].to_numpy()
+        previous = np.searchsorted(periods, periods, 'left') - 1
+        following = np.searchsorted(periods, periods, 'right')
+        following[following == len(periods)] = -1
+        names = country_events['Event'].tolist()
+        event_index[country] = {'periods': periods,
+                                'events': np.array(names, dtype=object),
+                                'years': country_events['Year'].to_numpy(),
+                                'positions': country_events['position'].to_numpy(),
+                                'previous': previous,
+                                'next': following,
+                                'lookup': {name: i for i, name in reversed(list(enumerate(names)))}}
+    return event_index
+
+
+def get_country_events(event_index:dict, country:str) -> (list, list, list):
+    """
+    Returns the events of a country from the event index in the same format as fetch_events_metadata
+
+    :param dict event_index: Event index built by build_event_index
+    :param str country: Country
+    :return: Returns 3 lists containing the corresponding periods, events and years
+    """
+    if country not in event_index:
+        return [], [], []
+    entry = event_index[country]
+    return entry['periods'].tolist(), entry['events'].tolist(), entry['years'].tolist()
+
+
+def get_neighbour_events(event_index:dict, country:str, period:str) -> (str, str):
+    """
+    Finds the closest event periods of a country before and after the given period
+
+    :param dict event_index: Event index built by build_event_index
+    :param str country: Country
+    :param str period: Period
+    :return: Previous and next event period, None if there is none
+    """
+    if country not in event_index:
+        return None, None
+    periods = event_index[country]['periods']
+    before, after = np.searchsorted(periods, period, 'left'), np.searchsorted(periods, period, 'right')
+    return periods[before - 1] if before > 0 else None, periods[after] if after < len(periods) else None
+
+
+def find_event(event_index:dict, country:str, event:str) -> dict:
+    """
+    Looks up a single event of a country
+
+    :param dict event_index: Event index built by build_event_index
+    :param str country: Country
+    :param str event: Name of the event
+    :return: Dictionary containing the period, year, row position and the previous and next event periods
+
+    >>> find_event({}, 'A', 'x')
+    Traceback (most recent call last):
+    ...
+    KeyError: "Event 'x' not found for A"
+    """
+    if country not in event_index or event not in event_index[country]['lookup']:
+        raise KeyError('Event {!r} not found for {}'.format(event, country))
+    entry = event_index[country]
+    i = entry['lookup'][event]
+    return {'period': entry['periods'][i],
+            'year': entry['years'][i],
+            'position': entry['positions'][i],
+            'previous': entry['periods'][entry['previous'][i]] if entry['previous'][i] >= 0 else None,
+            'next': entry['periods'][entry['next'][i]] if entry['next'][i] >= 0 else None}
+
+
 def plot_linechart(consolidated_df:pd.DataFrame, countries:list, x:str, y:str, value_vars:list=[], var_name:str='', regex_to_skip:str='all_gender',
-                   title:str='', title_font_size:int=20, line_palette:list=None, melt_flag:bool=True, hue:str=''):
+                   title:str='', title_font_size:int=20, line_palette:list=None, melt_flag:bool=True, hue:str='',
+                   output_path:str=None, text_iterations:int=None, event_index:dict=None, long_view:dict=None):
     """
     Plots the linechart from the given Dataframe and attibutes
-    :param consolidated_df: Dataframe to be used to plot the linechart
+    :param consolidated_df: Dataframe or store built by build_country_store to be used to plot the linechart
     :param countries: List of countries for which the plot needs to be created
     :param x: Column of Dataframe to be used as X axis
     :param y: Column of Dataframe to be used as Y axis
@@ -313,20 +1286,34 @@ def plot_linechart(consolidated_df:pd.DataFrame, countries:list, x:str, y:str, v
     :param line_palette: Colors to be used to plot the linechart
     :param melt_flag: Indicates whether to melt the dataframe
     :param hue: Grouping variable to plot different countries
+    :param output_path: File to save the plot to instead of showing it
+    :param text_iterations: Maximum number of adjust_text iterations, 0 skips adjusting the labels
+    :param event_index: Event index built by build_event_index from consolidated_df
+    :param long_view: Long view built by build_long_view from consolidated_df, used instead of melting
     :return: None
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     if line_palette is None:
         line_palette = ['red', 'green']
-    countries_regex_expr = ''
-    countries_regex_expr = countries_regex_expr.join(
-        val + '|' if i != len(countries) - 1 else val for i, val in enumerate(countries))
-    consolidated_country = consolidated_df.loc[
-        consolidated_df['Country'].str.contains(countries_regex_expr, regex=True)]
+    if _is_country_store(consolidated_df):
+        consolidated_country = get_country_frame(consolidated_df, countries)
+    else:
+        countries_regex_expr = ''
+        countries_regex_expr = countries_regex_expr.join(
+            val + '|' if i != len(countries) - 1 else val for i, val in enumerate(countries))
+        consolidated_country = consolidated_df.loc[
+            consolidated_df['Country'].str.contains(countries_regex_expr, regex=True)]
     consolidated_country = consolidated_country.sort_values(by=['Period'], ascending=[True])
     consolidated_country.reset_index(inplace=True, drop=True)
 
     plot_df = consolidated_country
-    if melt_flag:
+    if melt_flag and long_view is not None:
+        value_vars = [variable for variable in value_vars if not re.search(regex_to_skip, variable)]
+        plot_df = get_long_frame(long_view, countries, value_vars).rename(columns={'Variable': var_name, 'Value': y})
+        plot_df[var_name] = plot_df[var_name].cat.set_categories(value_vars)
+        plot_df = plot_df.sort_values(by=['Period'], kind='mergesort').reset_index(drop=True)
+    elif melt_flag:
         melted_country = consolidated_country.melt(id_vars=consolidated_country.columns[:6],
                                                    value_vars=value_vars,
                                                    var_name=var_name,
@@ -355,7 +1342,17 @@ def plot_linechart(consolidated_df:pd.DataFrame, countries:list, x:str, y:str, v
                      y=y,
                      hue=hue, palette=line_palette)
     ymin, ymax = g.get_ylim()
-    periods, events, years = fetch_events_metadata(consolidated_country)
+    if event_index is None:
+        periods, events, years = fetch_events_metadata(consolidated_country)
+        label_countries = [plot_df[plot_df['Event'] == event]['Country'].iloc[0] for event in events]
+    else:
+        periods, events, years, label_countries = [], [], [], []
+        for country in consolidated_country['Country'].unique():
+            country_periods, country_events, country_years = get_country_events(event_index, country)
+            periods += country_periods
+            events += country_events
+            years += country_years
+            label_countries += [country] * len(country_events)
     plt.title(title, fontsize=title_font_size)
     # plt.annotate('Gadaffi takes power [1969]', xy=(3,90), xytext=(3.5,89.5),
     #             arrowprops=dict(facecolor='black', shrink=0.05, headwidth=20, width=7))
@@ -366,32 +1363,285 @@ def plot_linechart(consolidated_df:pd.DataFrame, countries:list, x:str, y:str, v
     # plt.legend(loc='best')
     plt.legend(bbox_to_anchor=(1.04, 0.5), loc='center left', borderaxespad=0)
     texts = []
-    for period, event, year in zip(periods, events, years):
+    for period, event, year, label_country in zip(periods, events, years, label_countries):
         xtick = period_series[period_series == period].index[0]
         # print(xtick,period)
-        label_country=plot_df[plot_df['Event'] == event]['Country'].iloc[0]
         assign_label='('+label_country+') '+event + ' [' + year + ']'
         plt.axvline(x=xtick, color='orange', linestyle='-.', label=assign_label)
         texts.append(plt.text(xtick, (ymax + ymin) / 2, assign_label,
                               rotation=90, verticalalignment='center'))
-    adjust_text(texts, only_move={'texts': 'y'})
+    _adjust_texts(texts, text_iterations)
     # plt.plot()
-    plt.show()
-    # plt.close()
+    _finish_plot(output_path)
 
 
-def impute_regions(consolidated_df:pd.DataFrame) -> None:
+def impute_regions(consolidated_df:pd.DataFrame, inplace:bool=True) -> pd.DataFrame:
     """
-    Imputes the Region columns containing null values with the corresponding region
+    Imputes the Region columns containing null values with the first non-null region of the corresponding country,
+    using a single grouped pass. Countries without any region are printed and left as null
     :param consolidated_df: Dataframe
-    :return: None
+    :param inplace: Indicating whether to modify the given Dataframe instead of returning an imputed copy
+    :return: None if inplace else the imputed Dataframe
+
+    >>> df = pd.DataFrame({'Country': ['A', 'A', 'B', 'C'], 'Region': [np.nan, 'X', np.nan, 'Y']})
+    >>> impute_regions(df, inplace=False)
+    Countries without any region : ['B']
+      Country Region
+    0       A      X
+    1       A      X
+    2       B    NaN
+    3       C      Y
     """
-    for country in consolidated_df['Country'].unique():
-        filter = consolidated_df['Country'] == country
-        regions = consolidated_df.loc[filter, 'Region']
-        not_na = consolidated_df.loc[filter, 'Region'].notna()
-        impute_value = regions[not_na].iloc[0]
-        consolidated_df.loc[filter, 'Region'] = regions.fillna(impute_value)
+    regions = consolidated_df.groupby('Country', sort=False, observed=True)['Region'].transform('first')
+    missing = consolidated_df.loc[regions.isna() & consolidated_df['Country'].notna(), 'Country'].unique().tolist()
+    if missing:
+        print('Countries without any region : {}'.format(missing))
+    fill = consolidated_df['Region'].isna() & regions.notna()
+    if not inplace:
+        consolidated_df = consolidated_df.copy()
+    consolidated_df.loc[fill, 'Region'] = regions[fill]
+    return None if inplace else consolidated_df
+
+
+def build_country_store(consolidated_df:pd.DataFrame) -> dict:
+    """
+    Partitions the consolidated Dataframe by country once, with the rows of every country sorted by Period, so that
+    the rows of a country are a contiguous slice found with a dictionary lookup instead of a scan of the whole table.
+    The store can be passed in place of the Dataframe to the analysis and plotting functions
+    :param consolidated_df: Dataframe
+    :return: Dictionary containing the sorted frame and the slice of every country
+
+    >>> store = build_country_store(pd.DataFrame({'Country': ['Nigeria', 'Niger', 'Niger'],\
+    'Period': ['1950-1955', '1955-1960', '1950-1955']}))
+    >>> get_country_frame(store, 'Niger')
+      Country     Period
+    0   Niger  1950-1955
+    1   Niger  1955-1960
+    """
+    frame = consolidated_df[consolidated_df['Country'].notna()]
+    frame = frame.sort_values(['Country', 'Period'], kind='mergesort').reset_index(drop=True)
+    return {'frame': frame, 'slices': _country_slices(frame['Country'].to_numpy())}
+
+
+def _country_slices(countries:np.ndarray) -> dict:
+    """
+    Finds the slice of every country in an array of country names sorted by country
+    :param countries: Sorted array of country names
+    :return: Dictionary mapping each country to the start and stop of its rows
+    """
+    starts = np.flatnonzero(np.r_[True, countries[1:] != countries[:-1]]) if len(countries) else np.array([], int)
+    stops = np.r_[starts[1:], len(countries)]
+    return {countries[start]: (start, stop) for start, stop in zip(starts, stops)}
+
+
+def _is_country_store(data) -> bool:
+    """
+    Checks whether data is a store built by build_country_store
+    :param data: Dataframe or store
+    :return: True if data is a store
+    """
+    return isinstance(data, dict) and 'slices' in data and 'frame' in data
+
+
+def _store_positions(store:dict, country:str) -> np.ndarray:
+    """
+    Finds the positions of the rows of a country in the frame of a store. Countries are matched exactly, only names
+    which are not in the store match every country containing them, e.g. 'Venezuela'
+    :param store: Store built by build_country_store
+    :param country: Country
+    :return: Sorted positions of the rows
+    """
+    if country in store['slices']:
+        return np.arange(*store['slices'][country])
+    names = pd.Series(list(store['slices']), dtype=object)
+    matched = names[names.str.contains(country, regex=False)]
+    if not len(matched):
+        return np.array([], dtype=np.intp)
+    return np.concatenate([np.arange(*store['slices'][name]) for name in matched])
+
+
+def get_country_frame(store:dict, countries) -> pd.DataFrame:
+    """
+    Returns the rows of one or many countries from a store, sorted by Period within every country
+    :param store: Store built by build_country_store
+    :param countries: Country or list of countries
+    :return: Dataframe of the rows of the countries
+    """
+    if isinstance(countries, str):
+        if countries in store['slices']:
+            start, stop = store['slices'][countries]
+            return store['frame'].iloc[start:stop].reset_index(drop=True)
+        countries = [countries]
+    positions = [_store_positions(store, country) for country in countries]
+    return store['frame'].take(np.concatenate(positions + [np.array([], dtype=np.intp)])).reset_index(drop=True)
+
+
+def _country_positions(data, countries:list) -> (pd.DataFrame, dict):
+    """
+    Finds the rows of each of the given countries in a Dataframe or a store
+    :param data: Dataframe or store built by build_country_store
+    :param countries: List of countries
+    :return: Dataframe the positions refer to and dictionary mapping each country to the positions of its rows
+    """
+    if _is_country_store(data):
+        return data['frame'], {country: _store_positions(data, country) for country in countries}
+    return data, _match_countries(data, countries)
+
+
+GENDER_SUFFIXES = {'_all_gender': 'all', '_female': 'female', '_male': 'male'}
+
+
+def parse_variable_tags(variable:str) -> (str, str):
+    """
+    Splits the name of a value column into its indicator and gender
+    :param variable: Name of the column
+    :return: Indicator and gender, the gender is None for columns without a gender suffix
+
+    >>> parse_variable_tags('mortality_b60_female')
+    ('mortality_b60', 'female')
+    >>> parse_variable_tags('migration')
+    ('migration', None)
+    """
+    for suffix, gender in GENDER_SUFFIXES.items():
+        if variable.endswith(suffix):
+            return variable[:-len(suffix)], gender
+    return variable, None
+
+
+def _long_block(view:dict, data, variables:list) -> pd.DataFrame:
+    """
+    Melts the given columns of a Dataframe or store into rows of a long view
+    :param view: Long view built by build_long_view
+    :param data: Dataframe or store the view was built from
+    :param variables: Columns to melt
+    :return: Dataframe with the label columns and the Variable, Indicator, Gender and Value columns
+    """
+    frame = data['frame'] if _is_country_store(data) else data
+    ids = view['ids']
+    block = pd.concat([ids] * len(variables), ignore_index=True) if variables else ids.iloc[:0].copy()
+    tags = [view['tags'][variable] for variable in variables]
+    for column, values, categories in (('Variable', variables, view['variables']),
+                                       ('Indicator', [tag[0] for tag in tags], view['indicators']),
+                                       ('Gender', [tag[1] for tag in tags], view['genders'])):
+        block[column] = pd.Categorical(np.repeat(np.array(values, dtype=object), len(ids)), categories=categories)
+    values = [frame[variable].reindex(view['index']).to_numpy() for variable in variables]
+    block['Value'] = np.concatenate(values) if values else np.array([], dtype=float)
+    return block
+
+
+def build_long_view(consolidated_df:pd.DataFrame, value_vars:list=None) -> dict:
+    """
+    Melts the value columns of the consolidated Dataframe once into a long view, with one block of rows per column
+    and the rows of every block sorted by Country and Period. The column names are kept as categoricals together with
+    the indicator and gender parsed from them, so that rows can be selected by slicing instead of melting and regex
+    matching on every call
+    :param consolidated_df: Dataframe or store built by build_country_store
+    :param value_vars: Columns to melt, all columns after the six label columns if not given
+    :return: Dictionary containing the long Dataframe and the slices of its columns and countries
+
+    >>> view = build_long_view(pd.DataFrame({'Country': ['Niger', 'Chad'], 'Region': ['Western Africa', 'Middle Africa'],\
+    'Period': ['1950-1955'] * 2, 'Year': [None] * 2, 'Type': ['Country'] * 2, 'Event': [None] * 2,\
+    'mortality_male': [1.0, 2.0], 'mortality_female': [3.0, 4.0]}))
+    >>> get_long_frame(view, 'Chad')[['Country', 'Variable', 'Gender', 'Value']]
+      Country          Variable  Gender  Value
+    0    Chad    mortality_male    male    2.0
+    1    Chad  mortality_female  female    4.0
+    """
+    frame = consolidated_df['frame'] if _is_country_store(consolidated_df) else consolidated_df
+    if value_vars is None:
+        value_vars = frame.columns[6:].tolist()
+    frame = frame[frame['Country'].notna()].sort_values(['Country', 'Period'], kind='mergesort')
+    view = {'ids': frame[frame.columns[:6]].reset_index(drop=True),
+            'index': frame.index,
+            'slices': _country_slices(frame['Country'].to_numpy()),
+            'variables': [], 'indicators': [], 'genders': [], 'tags': {}, 'blocks': {},
+            'long_frame': None}
+    view['long_frame'] = _long_block(view, consolidated_df, [])
+    add_long_columns(view, consolidated_df, value_vars)
+    return view
+
+
+def add_long_columns(view:dict, consolidated_df:pd.DataFrame, value_vars:list) -> dict:
+    """
+    Adds columns of the consolidated Dataframe to a long view, only the new columns are melted. The rows of the
+    Dataframe are matched to the view by index, so columns can be added to the Dataframe after the view is built
+    :param view: Long view built by build_long_view
+    :param consolidated_df: Dataframe or store the view was built from
+    :param value_vars: Columns to add, columns already in the view are skipped
+    :return: The updated view
+    """
+    value_vars = [variable for variable in dict.fromkeys(value_vars) if variable not in view['blocks']]
+    if not value_vars:
+        return view
+    for variable in value_vars:
+        view['tags'][variable] = parse_variable_tags(variable)
+    view['variables'] += value_vars
+    view['indicators'] += [indicator for indicator in dict.fromkeys(view['tags'][variable][0] for variable in value_vars)
+                           if indicator not in view['indicators']]
+    view['genders'] += [gender for gender in dict.fromkeys(view['tags'][variable][1] for variable in value_vars)
+                        if gender is not None and gender not in view['genders']]
+    long_frame = view['long_frame']
+    for column, categories in (('Variable', view['variables']), ('Indicator', view['indicators']),
+                               ('Gender', view['genders'])):
+        long_frame[column] = long_frame[column].cat.set_categories(categories)
+    start = len(long_frame)
+    view['long_frame'] = pd.concat([long_frame, _long_block(view, consolidated_df, value_vars)], ignore_index=True)
+    for i, variable in enumerate(value_vars):
+        view['blocks'][variable] = (start + i * len(view['ids']), start + (i + 1) * len(view['ids']))
+    return view
+
+
+def get_long_frame(view:dict, countries=None, value_vars:list=None, indicators:list=None,
+                   genders:list=None) -> pd.DataFrame:
+    """
+    Returns rows of a long view, selected by country and by column, indicator or gender. A single country of a single
+    column is returned as a slice of the view without copying
+    :param view: Long view built by build_long_view
+    :param countries: Country or list of countries, all countries if not given
+    :param value_vars: Columns to return, all columns of the view if not given
+    :param indicators: Indicators to keep, e.g. ['mortality']
+    :param genders: Genders to keep, e.g. ['male', 'female']
+    :return: Dataframe with one row per country, period and column
+    """
+    if value_vars is None:
+        value_vars = view['variables']
+    missing = [variable for variable in value_vars if variable not in view['blocks']]
+    if missing:
+        raise KeyError('Columns not in the long view: {}'.format(missing))
+    value_vars = [variable for variable in value_vars
+                  if (indicators is None or view['tags'][variable][0] in indicators)
+                  and (genders is None or view['tags'][variable][1] in genders)]
+    if isinstance(countries, str):
+        countries = [countries]
+    if countries is None:
+        positions = np.arange(len(view['ids']))
+    else:
+        positions = np.concatenate([_store_positions(view, country) for country in countries]
+                                   + [np.array([], dtype=np.intp)])
+    if len(value_vars) == 1 and len(positions) and (np.diff(positions) == 1).all():
+        start = view['blocks'][value_vars[0]][0]
+        return view['long_frame'].iloc[start + positions[0]:start + positions[-1] + 1]
+    rows = [view['blocks'][variable][0] + positions for variable in value_vars]
+    return view['long_frame'].take(np.concatenate(rows + [np.array([], dtype=np.intp)])).reset_index(drop=True)
+
+
+def _match_countries(consolidated_df:pd.DataFrame, countries:list) -> dict:
+    """
+    Finds the positions of the rows belonging to each of the given countries. A country matches every country name
+    containing it, as with consolidated_df['Country'].str.contains(country), but the pattern is only evaluated against
+    the unique country names instead of every row
+    :param consolidated_df: Dataframe
+    :param countries: List of countries
+    :return: Dictionary mapping each country to the sorted positions of its rows
+    """
+    groups = consolidated_df.groupby('Country', sort=False, observed=True).indices
+    names = pd.Series(list(groups.keys()), dtype=object)
+    positions = {}
+    for country in countries:
+        matched = names[names.str.contains(country)]
+        positions[country] = np.sort(np.concatenate([groups[name] for name in matched])) if len(matched) else \
+            np.array([], dtype=np.intp)
+    return positions
 
 
 def calculate_percent_change(consolidated_df:pd.DataFrame, countries:list,
@@ -401,8 +1651,10 @@ def calculate_percent_change(consolidated_df:pd.DataFrame, countries:list,
                              pre_name:str='Pre',
                              post_name:str='Post') -> pd.DataFrame:
     """
-    Creates a dataframe which contains the percent change for given attributes
-    :param consolidated_df: Dataframe
+    Creates a dataframe which contains the percent change for given attributes. The pre window of an event period spans
+    the periods after the previous event period and the post window the periods before the next event period. Every row
+    is labelled once with the window it falls in, so all the means are reduced in a single pass over the rows
+    :param consolidated_df: Dataframe or store built by build_country_store
     :param countries: Countries for which the dataframe needs to be filtered
     :param level_two: List of names to be assigned to level two of the multi-index
     :param calc_attrs: Columns for which the percentage change needs to be calculated
@@ -411,56 +1663,332 @@ def calculate_percent_change(consolidated_df:pd.DataFrame, countries:list,
     :param post_name: Name of the column containing the post values wrt reference
     :return: Dataframe which contains the percent change for given attributes
     """
-    list_of_dfs = []
-    for country in countries:
-        tmp_df = consolidated_df.loc[consolidated_df['Country'].str.contains(country)].copy()
-        tmp_df = tmp_df.sort_values('Period')
-        # display(tmp_df)
-        periods, events, _ = fetch_events_metadata(tmp_df)
-        tmp_dict = {'Period': [], 'Event': [], 'Pre': [], 'Post': []}
-        # tmp_dict['Year']=[]
-        set_of_periods = sorted(set(periods))
-        list_of_tuples = []
-        # periods=pd.Series(periods)
-        for period in set_of_periods:
-            # first get the list of events and year
-            frame_of_period = tmp_df.loc[tmp_df['Period'] == period]
-            spec_events = frame_of_period['Event'].tolist()
-            years = frame_of_period['Year'].tolist()
-            for event, year in zip(spec_events, years):
-                # tmp_dict['Period'].append(period)
-                # tmp_dict['Event'].append(event)
-                # tmp_dict['Year'].append(year)
-                pre_filter = tmp_df['Period'] < period
-                post_filter = tmp_df['Period'] > period
-                if events.index(spec_events[-1]) + 1 < len(events):
-                    post_filter = (tmp_df['Period'] > period) & (
-                            tmp_df['Period'] < periods[events.index(spec_events[-1]) + 1])
-                if events.index(spec_events[0]) - 1 > 0:
-                    pre_filter = (tmp_df['Period'] < period) & (
-                            tmp_df['Period'] > periods[events.index(spec_events[0]) - 1])
-                for group_type, col in zip(level_two, calc_attrs):
-                    tmp_dict['Period'].append(period)
-                    tmp_dict['Event'].append(event)
-                    # tmp_dict['Year'].append(year)
-                    tmp_dict['Pre'].append(round(tmp_df.loc[pre_filter, col].mean(), 2))
-                    tmp_dict['Post'].append(round(tmp_df.loc[post_filter, col].mean(), 2))
-                    list_of_tuples.append((country, group_type, year))
-        change_df = pd.DataFrame.from_dict(tmp_dict)
-        change_df['% Change'] = round(((change_df['Post'] - change_df['Pre']) / change_df['Pre']) * 100, 2)
-        change_df.rename(columns={"Pre": pre_name, "Post": post_name}, inplace=True)
-        index = pd.MultiIndex.from_tuples(list_of_tuples, names=['Country', level_two_name, 'Year'])
-        change_df = change_df.set_index(index)
-        change_df = change_df.sort_index()
-        list_of_dfs.append(change_df)
-    major_df = pd.concat(list_of_dfs)
+    group_types, attrs = list(level_two[:len(calc_attrs)]), list(calc_attrs[:len(level_two)])
+    consolidated_df, positions = _country_positions(consolidated_df, countries)
+    keys = np.repeat(np.arange(len(countries)), [len(positions[country]) for country in countries])
+    tmp_df = consolidated_df.take(np.concatenate([positions[country] for country in countries] +
+                                                 [np.array([], dtype=np.intp)]))
+    tmp_df = tmp_df[['Period', 'Event', 'Year'] + list(dict.fromkeys(attrs))].assign(key=keys)
+    tmp_df = tmp_df.sort_values(['key', 'Period'], kind='mergesort')
+
+    # label rows by window: 2j is the window between event periods j-1 and j, 2j+1 is event period j itself
+    row_keys = tmp_df['key'].to_numpy(dtype=np.int64)
+    period_codes = tmp_df['Period'].rank(method='dense').fillna(0).to_numpy(dtype=np.int64)
+    n_codes = period_codes.max(initial=0) + 1
+    combined = row_keys * n_codes + period_codes
+    has_event = tmp_df['Event'].notna().to_numpy()
+    event_periods = np.unique(combined[has_event])
+    j_global = np.searchsorted(event_periods, combined)
+    on_event = np.isin(combined, event_periods)
+    j = j_global - np.searchsorted(event_periods, row_keys * n_codes)
+    labels = 2 * j + on_event
+    n_labels = int(labels.max(initial=0)) + 3
+    # rows are sorted by country and period, so every window is a contiguous range of rows
+    row_windows = row_keys * n_labels + labels
+
+    events_df = tmp_df[has_event]
+    event_keys = events_df['key'].to_numpy(dtype=np.int64)
+    event_j = j[has_event]
+    # number of events of the country before the event period, matching events.index() of the first event in it
+    first_index = events_df.groupby('key').cumcount().to_numpy() - \
+        events_df.groupby(['key', 'Period']).cumcount().to_numpy()
+    # events.index(...) - 1 > 0 leaves the second event without a lower bound, so its pre window also spans the first
+    # event period and everything before it
+    pre_low = np.where((first_index - 1 <= 0) & (event_j > 0), 0, 2 * event_j)
+    bounds = np.stack([np.searchsorted(row_windows, event_keys * n_labels + pre_low, 'left'),
+                       np.searchsorted(row_windows, event_keys * n_labels + 2 * event_j, 'right'),
+                       np.searchsorted(row_windows, event_keys * n_labels + 2 * event_j + 2, 'left'),
+                       np.searchsorted(row_windows, event_keys * n_labels + 2 * event_j + 2, 'right')], axis=1)
+
+    values = tmp_df[attrs].to_numpy(dtype=float)
+    not_null = ~np.isnan(values)
+    # nulls are summed as zero and left out of the counts, as Series.mean skips them
+    padded = np.vstack([np.where(not_null, values, 0.0), np.zeros((1, len(attrs)))])
+    sums = np.add.reduceat(padded, bounds.ravel(), axis=0)[0::2] if len(bounds) else np.zeros((0, len(attrs)))
+    counts = np.vstack([np.zeros((1, len(attrs))), np.cumsum(not_null, axis=0)])
+    counts = counts[bounds[:, 1::2].ravel()] - counts[bounds[:, 0::2].ravel()]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        means = np.where(counts > 0, sums, np.nan) / counts
+    pre, post = means[0::2], means[1::2]
+
+    n_attrs = len(attrs)
+    change_df = pd.DataFrame({'Period': np.repeat(events_df['Period'].to_numpy(), n_attrs),
+                              'Event': np.repeat(events_df['Event'].to_numpy(), n_attrs),
+                              'Pre': np.round(pre.ravel(), 2),
+                              'Post': np.round(post.ravel(), 2)})
+    change_df['% Change'] = round(((change_df['Post'] - change_df['Pre']) / change_df['Pre']) * 100, 2)
+    change_df.rename(columns={"Pre": pre_name, "Post": post_name}, inplace=True)
+    order_df = pd.DataFrame({'key': np.repeat(event_keys, n_attrs),
+                             'Country': np.repeat(np.array(countries, dtype=object)[event_keys], n_attrs),
+                             level_two_name: np.tile(np.array(group_types, dtype=object), len(events_df)),
+                             'Year': np.repeat(events_df['Year'].to_numpy(), n_attrs)})
+    order = order_df.sort_values(['key', 'Country', level_two_name, 'Year'], kind='mergesort').index
+    index = pd.MultiIndex.from_frame(order_df.loc[order, ['Country', level_two_name, 'Year']],
+                                     names=['Country', level_two_name, 'Year'])
+    major_df = change_df.loc[order].set_index(index)
     return major_df
 
 
-def plot_correlation(consolidated_df:pd.DataFrame, country:str, x:str, y:str, hue:str, title:str, text_flag:bool=True, text_pos:list=None) -> None:
+CORRELATION_METHODS = ('pearson', 'spearman')
+
+
+def _masked_pearson(x:np.ndarray, y:np.ndarray, valid:np.ndarray) -> np.ndarray:
+    """
+    Computes the Pearson correlation along the second axis over the valid entries only
+    :param x: Array of shape (segments, periods, pairs)
+    :param y: Array of the same shape as x
+    :param valid: Boolean array of the same shape as x
+    :return: Array of shape (segments, pairs), NaN where a series is constant
+    """
+    n = valid.sum(axis=1, keepdims=True)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dx = np.where(valid, x - np.where(valid, x, 0).sum(axis=1, keepdims=True) / n, 0)
+        dy = np.where(valid, y - np.where(valid, y, 0).sum(axis=1, keepdims=True) / n, 0)
+        return (dx * dy).sum(axis=1) / np.sqrt((dx * dx).sum(axis=1) * (dy * dy).sum(axis=1))
+
+
+def _masked_ranks(x:np.ndarray, valid:np.ndarray) -> np.ndarray:
+    """
+    Ranks the valid entries along the second axis, ties get their average rank
+    :param x: Array of shape (segments, periods, pairs)
+    :param valid: Boolean array of the same shape as x
+    :return: Array of ranks, NaN where not valid, all NaN if there are no periods
+    """
+    segments, periods, pairs = x.shape
+    if periods == 0:
+        return np.full(x.shape, np.nan)
+    flat = np.where(valid, x, np.nan).transpose(0, 2, 1).reshape(-1, periods)
+    ranks = pd.DataFrame(flat).rank(axis=1, method='average').to_numpy()
+    return ranks.reshape(segments, pairs, periods).transpose(0, 2, 1)
+
+
+def calculate_correlations(consolidated_df:pd.DataFrame, pairs:list=None, value_vars:list=None, methods:list=None,
+                           lags:list=None, split_events:bool=False, min_periods:int=3) -> pd.DataFrame:
+    """
+    Computes the correlations of pairs of columns for every country in a single pass. The table is pivoted into a
+    country x period x column array once, and every pair, country and window is reduced at once with NumPy. A lag of k
+    correlates x in a period with y k periods later. With split_events, the periods of every event of a country are
+    split into a pre window, the periods before the period of the event, and a post window, the period of the event
+    and the periods after it. The first row of every Country and Period is used, as in plot_correlation, and
+    the periods where x or y is missing are skipped
+    :param consolidated_df: Dataframe or store built by build_country_store
+    :param pairs: List of (x, y) column pairs, every pair of value_vars if not given
+    :param value_vars: Columns to pair, all numeric columns after the six label columns if not given
+    :param methods: List of methods among 'pearson' and 'spearman', ['pearson'] if not given
+    :param lags: List of lags in periods, [0] if not given
+    :param split_events: Indicates whether to add the pre and post windows of every event
+    :param min_periods: Minimum number of periods for a correlation, fewer give NaN
+    :return: Dataframe with one row per country, window, pair and lag
+
+    >>> df = pd.DataFrame({'Country': ['Chad'] * 4, 'Region': ['Middle Africa'] * 4,\
+    'Period': ['1950-1955', '1955-1960', '1960-1965', '1965-1970'], 'Year': [None] * 4, 'Type': ['Country'] * 4,\
+    'Event': [None] * 4, 'migration': [1.0, 2.0, 3.0, 4.0], 'life_expectancy_all_gender': [40.0, 42.0, 41.0, 45.0]})
+    >>> calculate_correlations(df, methods=['pearson', 'spearman'], lags=[0, 1],\
+    min_periods=2)[['Country', 'Lag', 'Observations', 'pearson', 'spearman']].round(2)
+      Country  Lag  Observations  pearson  spearman
+    0    Chad    0             4     0.84       0.8
+    1    Chad    1             3     0.72       0.5
+    """
+    frame = consolidated_df['frame'] if _is_country_store(consolidated_df) else consolidated_df
+    methods = ['pearson'] if methods is None else list(methods)
+    unknown = [method for method in methods if method not in CORRELATION_METHODS]
+    if unknown:
+        raise ValueError('Unknown correlation methods {}, expected one of {}'.format(unknown, CORRELATION_METHODS))
+    lags = [0] if lags is None else list(lags)
+    if value_vars is None:
+        value_vars = frame[frame.columns[6:]].select_dtypes('number').columns.tolist()
+    if pairs is None:
+        pairs = [(x, y) for i, x in enumerate(value_vars) for y in value_vars[i + 1:]]
+    columns = list(dict.fromkeys(column for pair in pairs for column in pair))
+    missing = [column for column in columns if column not in frame.columns]
+    if missing:
+        raise KeyError('Columns not in the Dataframe: {}'.format(missing))
+
+    frame = frame[frame['Country'].notna()]
+    rows = frame.drop_duplicates(subset=['Country', 'Period'], keep='first')
+    country_codes, countries = pd.factorize(rows['Country'], sort=True)
+    period_codes, periods = pd.factorize(rows['Period'], sort=True)
+    cube = np.full((len(countries), len(periods), len(columns)), np.nan)
+    cube[country_codes, period_codes] = rows[columns].to_numpy(dtype=float)
+
+    segment_countries = np.arange(len(countries))
+    segment_masks = np.ones((len(countries), len(periods)), dtype=bool)
+    segment_events, segment_windows = [None] * len(countries), ['All'] * len(countries)
+    if split_events:
+        events = frame.loc[frame['Event'].notna(), ['Country', 'Period', 'Event']].drop_duplicates()
+        event_countries = countries.get_indexer(events['Country'])
+        event_periods = periods.get_indexer(events['Period'])
+        before = np.arange(len(periods))[None, :] < event_periods[:, None]
+        segment_countries = np.r_[segment_countries, event_countries, event_countries]
+        segment_masks = np.r_[segment_masks, before, ~before]
+        segment_events += events['Event'].tolist() * 2
+        segment_windows += ['Pre'] * len(events) + ['Post'] * len(events)
+
+    x_columns = [columns.index(x) for x, y in pairs]
+    y_columns = [columns.index(y) for x, y in pairs]
+    segments = cube[segment_countries]
+    results = []
+    for lag in lags:
+        x_periods = slice(0, max(len(periods) - lag, 0)) if lag >= 0 else slice(-lag, len(periods))
+        y_periods = slice(lag, len(periods)) if lag >= 0 else slice(0, max(len(periods) + lag, 0))
+        x = segments[:, x_periods][:, :, x_columns]
+        y = segments[:, y_periods][:, :, y_columns]
+        valid = (segment_masks[:, x_periods] & segment_masks[:, y_periods])[:, :, None] & ~np.isnan(x) & ~np.isnan(y)
+        observations = valid.sum(axis=1)
+        result = pd.DataFrame({'Country': np.repeat(countries.to_numpy()[segment_countries], len(pairs)),
+                               'Event': np.repeat(np.array(segment_events, dtype=object), len(pairs)),
+                               'Window': np.repeat(segment_windows, len(pairs)),
+                               'x': np.tile([x for x, y in pairs], len(segment_countries)),
+                               'y': np.tile([y for x, y in pairs], len(segment_countries)),
+                               'Lag': lag,
+                               'Observations': observations.ravel()})
+        for method in methods:
+            if method == 'spearman':
+                correlations = _masked_pearson(_masked_ranks(x, valid), _masked_ranks(y, valid), valid)
+            else:
+                correlations = _masked_pearson(x, y, valid)
+            result[method] = np.where(observations >= min_periods, correlations, np.nan).ravel()
+        results.append(result)
+    correlations_df = pd.concat(results, ignore_index=True)
+    return correlations_df.sort_values('Country', kind='mergesort').reset_index(drop=True)
+
+
+AGE_CUBE_AXES = ('countries', 'periods', 'ages', 'sexes')
+
+
+def build_age_cube(frames:dict, cube_dir:str, age_columns:list=None, dtype:str='float64') -> dict:
+    """
+    Writes by-age Dataframes into a memory-mapped country x period x age group x sex array, with the labels of the
+    axes in a small json file next to it. The frames are the by-age files transformed by transform_dataframe, one per
+    sex, e.g. {'both': ..., 'male': ..., 'female': ...}. The age group of a column is the last word of its name, so
+    columns renamed by rename_columns keep their age group
+    :param frames: Dictionary mapping each sex to its transformed by-age Dataframe
+    :param cube_dir: Directory to write cube.npy and labels.json to
+    :param age_columns: Age group columns, all columns after Period except Region if not given
+    :param dtype: Data type of the array
+    :return: The cube opened read-only by open_age_cube
+    """
+    if not frames:
+        raise ValueError('No by-age Dataframes given')
+    first = next(iter(frames.values()))
+    if age_columns is None:
+        start = first.columns.get_loc('Period') + 1
+        age_columns = [column for column in first.columns[start:] if column != 'Region']
+    countries = pd.Index(sorted(set().union(*(frame['Country'].dropna().unique() for frame in frames.values()))))
+    periods = pd.Index(sorted(set().union(*(frame['Period'].dropna().unique() for frame in frames.values()))))
+    labels = {'countries': countries.tolist(), 'periods': periods.tolist(),
+              'ages': [str(column).split()[-1] for column in age_columns], 'sexes': list(frames)}
+    os.makedirs(cube_dir, exist_ok=True)
+    data = np.lib.format.open_memmap(os.path.join(cube_dir, 'cube.npy'), mode='w+', dtype=dtype,
+                                     shape=tuple(len(labels[axis]) for axis in AGE_CUBE_AXES))
+    data[:] = np.nan
+    for sex, frame in enumerate(frames.values()):
+        frame = frame[frame['Country'].notna() & frame['Period'].notna()]
+        values = replace_placeholders(frame[age_columns]).to_numpy(dtype=dtype)
+        data[countries.get_indexer(frame['Country']), periods.get_indexer(frame['Period']), :, sex] = values
+    data.flush()
+    del data
+    with open(os.path.join(cube_dir, 'labels.json'), 'w') as f:
+        json.dump(labels, f)
+    return open_age_cube(cube_dir)
+
+
+def open_age_cube(cube_dir:str, mode:str='r') -> dict:
+    """
+    Opens a cube written by build_age_cube. The array is memory-mapped, so processes opening the same cube share the
+    pages of the file instead of loading their own copy
+    :param cube_dir: Directory containing cube.npy and labels.json
+    :param mode: Memory-map mode, 'r' for read-only or 'r+' to update the values in place
+    :return: Dictionary containing the array and the label index of every axis
+    """
+    with open(os.path.join(cube_dir, 'labels.json')) as f:
+        labels = json.load(f)
+    cube = {axis: pd.Index(labels[axis], dtype=object) for axis in AGE_CUBE_AXES}
+    cube['data'] = np.load(os.path.join(cube_dir, 'cube.npy'), mmap_mode=mode)
+    return cube
+
+
+def _axis_selector(labels:pd.Index, selection) -> (object, pd.Index):
+    """
+    Converts labels to a selector of an axis of a cube, a slice when the labels are contiguous
+    :param labels: Label index of the axis
+    :param selection: Label, list of labels or None for the whole axis
+    :return: Slice or array of positions and the selected labels
+    """
+    if selection is None:
+        return slice(None), labels
+    if isinstance(selection, str):
+        selection = [selection]
+    positions = labels.get_indexer(selection)
+    if (positions < 0).any():
+        raise KeyError('Labels not in the cube: {}'.format([label for label, position in zip(selection, positions)
+                                                            if position < 0]))
+    if len(positions) and (np.diff(positions) == 1).all():
+        return slice(positions[0], positions[-1] + 1), labels[positions[0]:positions[-1] + 1]
+    return positions, labels[positions]
+
+
+def select_age_cube(cube:dict, countries=None, periods=None, ages=None, sexes=None) -> dict:
+    """
+    Selects a part of a cube by label. Every axis is kept, and a selection of contiguous labels on every axis, e.g. a
+    single country or a run of age groups, is a view of the memory-mapped array without copying
+    :param cube: Cube opened by open_age_cube
+    :param countries: Country or list of countries
+    :param periods: Period or list of periods
+    :param ages: Age group or list of age groups
+    :param sexes: Sex or list of sexes
+    :return: Dictionary containing the selected array and labels
+    """
+    selected = {}
+    data = cube['data']
+    for axis, (name, selection) in enumerate(zip(AGE_CUBE_AXES, (countries, periods, ages, sexes))):
+        selector, selected[name] = _axis_selector(cube[name], selection)
+        data = data[(slice(None),) * axis + (selector,)]
+    selected['data'] = data
+    return selected
+
+
+def aggregate_age_bands(cube:dict, bands:dict, how:str='sum') -> dict:
+    """
+    Aggregates the age groups of a cube into age bands. Every band is a contiguous run of age groups, reduced as a view
+    of the array for all the countries, periods and sexes at once. Missing values are skipped, a band without any value
+    is NaN
+    :param cube: Cube opened by open_age_cube or selected by select_age_cube
+    :param bands: Dictionary mapping each band to the first and last age group it covers
+    :param how: 'sum' or 'mean'
+    :return: Cube with the bands in place of the age groups
+
+    >>> cube = {'countries': pd.Index(['Chad']), 'periods': pd.Index(['1950-1955']), 'ages': pd.Index(['0-4', '5-9',\
+    '10-14']), 'sexes': pd.Index(['male', 'female']), 'data': np.arange(6.0).reshape(1, 1, 3, 2)}
+    >>> aggregate_age_bands(cube, {'0-9': ('0-4', '5-9'), '10+': ('10-14', '10-14')})['data'][0, 0]
+    array([[2., 4.],
+           [4., 5.]])
+    """
+    if how not in ('sum', 'mean'):
+        raise ValueError("how must be 'sum' or 'mean', got {}".format(how))
+    data = cube['data']
+    aggregated = np.empty(data.shape[:2] + (len(bands),) + data.shape[3:])
+    for i, (first, last) in enumerate(bands.values()):
+        selector, _ = _axis_selector(cube['ages'], [first, last])
+        if not isinstance(selector, slice):
+            start, stop = sorted(selector)
+            selector = slice(start, stop + 1)
+        band = data[:, :, selector]
+        counts = (~np.isnan(band)).sum(axis=2)
+        totals = np.nansum(band, axis=2)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            aggregated[:, :, i] = np.where(counts > 0, totals / counts if how == 'mean' else totals, np.nan)
+    aggregated_cube = {axis: cube[axis] for axis in AGE_CUBE_AXES}
+    aggregated_cube['ages'] = pd.Index(list(bands), dtype=object)
+    aggregated_cube['data'] = aggregated
+    return aggregated_cube
+
+
+def plot_correlation(consolidated_df:pd.DataFrame, country:str, x:str, y:str, hue:str, title:str, text_flag:bool=True, text_pos:list=None,
+                     output_path:str=None, text_iterations:int=None) -> None:
     """
     Plots the correlation plot of the given attributes
-    :param consolidated_df: Dataframe
+    :param consolidated_df: Dataframe or store built by build_country_store
     :param country: Country for which plots needs to be created
     :param x: Column of Dataframe to be used as X axis
     :param y: Column of Dataframe to be used as Y axis
@@ -468,14 +1996,21 @@ def plot_correlation(consolidated_df:pd.DataFrame, country:str, x:str, y:str, hu
     :param title: Title of the plot
     :param text_flag: Flag which indicates whether correlation coefficient needs to be displayed on the graph
     :param text_pos: The position of the correlation coefficient on the graph
+    :param output_path: File to save the plot to instead of showing it
+    :param text_iterations: Maximum number of adjust_text iterations, 0 skips adjusting the labels
     :return: None
     """
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     # sns.scatterplot(data=df,
     #                 x=x,
     #                 y=y,hue=hue,s=100)
     if text_pos is None:
         text_pos = [0, 0]
-    consolidated_country = consolidated_df.loc[consolidated_df['Country'].str.contains(country)]
+    if _is_country_store(consolidated_df):
+        consolidated_country = get_country_frame(consolidated_df, country)
+    else:
+        consolidated_country = consolidated_df.loc[consolidated_df['Country'].str.contains(country)]
     consolidated_country = consolidated_country.dropna(subset=consolidated_country.columns[6:])
     consolidated_country = consolidated_country.drop_duplicates(subset='Period', keep="first")
     consolidated_country.reset_index(inplace=True, drop=True)
@@ -499,6 +2034,328 @@ def plot_correlation(consolidated_df:pd.DataFrame, country:str, x:str, y:str, hu
                  size='medium',
                  color='black',
                  weight='semibold')
-    adjust_text(texts, only_move={'texts': 'y'})
+    _adjust_texts(texts, text_iterations)
     plt.title(title, fontsize=20)
-    plt.show()
+    _finish_plot(output_path)
+
+
+def _adjust_texts(texts:list, iterations:int=None) -> None:
+    """
+    Runs adjust_text on the labels of the current plot
+    :param texts: List of text objects
+    :param iterations: Maximum number of iterations, 0 skips adjusting and None uses the adjustText default
+    :return: None
+    """
+    if iterations == 0 or not texts:
+        return
+    from adjustText import adjust_text
+    kwargs = {}
+    if iterations is not None:
+        # adjustText renamed lim to iter_lim in 1.0
+        kwargs['iter_lim' if 'iter_lim' in inspect.signature(adjust_text).parameters else 'lim'] = iterations
+    adjust_text(texts, only_move={'texts': 'y'}, **kwargs)
+
+
+def _finish_plot(output_path:str=None) -> None:
+    """
+    Shows the current plot, or saves it to output_path and closes it
+    :param output_path: File to save the plot to
+    :return: None
+    """
+    import matplotlib.pyplot as plt
+    if output_path is None:
+        plt.show()
+        return
+    plt.savefig(output_path, bbox_inches='tight')
+    plt.close('all')
+
+
+PLOT_FUNCTIONS = {'barchart': plot_barchart, 'linechart': plot_linechart, 'correlation': plot_correlation}
+
+
+def _init_render_worker() -> None:
+    """
+    Switches a worker process of render_plots to the Agg backend
+    :return: None
+    """
+    import matplotlib.pyplot as plt
+    plt.switch_backend('Agg')
+
+
+def _render_job(job:dict, country_df:pd.DataFrame, output_path:str, text_iterations:int) -> str:
+    """
+    Renders a single job of render_plots to a file, the caller selects the Agg backend
+    :param job: Dictionary containing the plot type, country and parameters
+    :param country_df: Rows of the countries of the job
+    :param output_path: File to save the plot to
+    :param text_iterations: Maximum number of adjust_text iterations
+    :return: Path of the saved plot
+    """
+    params = dict(job.get('params', {}))
+    params['output_path'] = output_path
+    if job['plot'] != 'barchart':
+        params.setdefault('text_iterations', text_iterations)
+    countries = job['country']
+    if job['plot'] == 'linechart' and isinstance(countries, str):
+        countries = [countries]
+    PLOT_FUNCTIONS[job['plot']](country_df, countries, **params)
+    return output_path
+
+
+def render_plots(consolidated_df:pd.DataFrame, jobs:list, output_dir:str, fmt:str='png', max_workers:int=None,
+                 text_iterations:int=None) -> list:
+    """
+    Renders a batch of plots to files in a process pool using the Agg backend, without displaying them. Each job is a
+    dictionary with the plot type ('barchart', 'linechart' or 'correlation'), the country (a list of countries for
+    linecharts), the keyword arguments of the plot function in params and optionally the filename. Every worker only
+    receives the rows of the countries of its job. Jobs rendered in the calling process restore its backend afterwards
+    :param consolidated_df: Dataframe or store built by build_country_store
+    :param jobs: List of dictionaries describing the plots
+    :param output_dir: Directory to save the plots in
+    :param fmt: File format of the plots, e.g. png or svg
+    :param max_workers: Number of worker processes, defaults to the number of CPUs
+    :param text_iterations: Maximum number of adjust_text iterations, 0 skips adjusting the labels
+    :return: List of paths of the saved plots in job order
+
+    >>> render_plots(pd.DataFrame({'Country': []}), [{'plot': 'piechart', 'country': 'Libya'}], '.')
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown plot types : ['piechart']
+    """
+    unknown = sorted({job['plot'] for job in jobs} - set(PLOT_FUNCTIONS))
+    if unknown:
+        raise ValueError('Unknown plot types : {}'.format(unknown))
+    os.makedirs(output_dir, exist_ok=True)
+    job_countries = [[job['country']] if isinstance(job['country'], str) else list(job['country']) for job in jobs]
+    consolidated_df, positions = _country_positions(consolidated_df, sorted({country for countries in job_countries
+                                                                             for country in countries}))
+    country_dfs = [consolidated_df.take(np.unique(np.concatenate([positions[country] for country in countries])))
+                   for countries in job_countries]
+    output_paths = [os.path.join(output_dir, job.get('filename') or '{}_{}_{}.{}'.format(
+        job['plot'], '_'.join(countries), i, fmt).replace(' ', '_')) for i, (job, countries) in
+        enumerate(zip(jobs, job_countries))]
+    iterations = [text_iterations] * len(jobs)
+    if max_workers == 1 or len(jobs) < 2:
+        # rendered in the calling process, e.g. a notebook, whose backend is restored afterwards
+        import matplotlib.pyplot as plt
+        backend = plt.get_backend()
+        plt.switch_backend('Agg')
+        try:
+            return [_render_job(*args) for args in zip(jobs, country_dfs, output_paths, iterations)]
+        finally:
+            plt.switch_backend(backend)
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_init_render_worker) as executor:
+        return list(executor.map(_render_job, jobs, country_dfs, output_paths, iterations))
+
+
+def _frame_shape(obj) -> (int, int):
+    """
+    Returns the number of rows and columns of a Dataframe or of the frame of a store built by build_country_store, or
+    their totals for a list or dictionary of Dataframes
+    :param obj: Object to measure
+    :return: Number of rows and columns, None if obj contains no Dataframe
+    """
+    if _is_country_store(obj):
+        obj = obj['frame']
+    if isinstance(obj, pd.DataFrame):
+        return obj.shape
+    if isinstance(obj, dict):
+        obj = list(obj.values())
+    if isinstance(obj, (list, tuple)):
+        shapes = [df.shape for df in obj if isinstance(df, pd.DataFrame)]
+        if shapes:
+            return sum(rows for rows, _ in shapes), sum(columns for _, columns in shapes)
+    return None, None
+
+
+def _peak_rss_mb() -> float:
+    """
+    Returns the peak resident set size of the process in MB, None where the resource module is not available
+    :return: Peak resident set size in MB
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return peak / 2 ** 20 if sys.platform == 'darwin' else peak / 2 ** 10
+
+
+def _start_memory_trace() -> dict:
+    """
+    Registers an outermost traced call, tracemalloc is started by the first of the calls running at the same time
+    :return: State of the call, to be passed to _stop_memory_trace
+    """
+    with _memory_tracing['lock']:
+        calls = _memory_tracing['calls']
+        call = {'overlapped': bool(calls)}
+        for other in calls:
+            other['overlapped'] = True
+        if not calls and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _memory_tracing['started'] = True
+        calls.append(call)
+    return call
+
+
+def _stop_memory_trace(call:dict) -> float:
+    """
+    Unregisters an outermost traced call, tracemalloc is stopped by the last of the calls running at the same time
+    if it was started by _start_memory_trace
+    :param call: State of the call returned by _start_memory_trace
+    :return: Peak traced memory in MB, None if the call overlapped another traced call since the peak then includes
+        the allocations of the other calls
+    """
+    with _memory_tracing['lock']:
+        peak = None if call['overlapped'] else tracemalloc.get_traced_memory()[1] / 2 ** 20
+        _memory_tracing['calls'].remove(call)
+        if not _memory_tracing['calls'] and _memory_tracing['started']:
+            tracemalloc.stop()
+            _memory_tracing['started'] = False
+    return peak
+
+
+def _instrument(func):
+    """
+    Wraps a function so that its calls are measured and sent to the sinks while instrumentation is enabled
+    :param func: Function to wrap
+    :return: Wrapped function
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _instrumentation['enabled']:
+            return func(*args, **kwargs)
+        inputs = [arg for arg in list(args) + list(kwargs.values())
+                  if isinstance(arg, pd.DataFrame) or _is_country_store(arg)]
+        input_rows, input_columns = _frame_shape(inputs[0]) if inputs else (None, None)
+        depth = getattr(_instrumentation_depth, 'value', 0)
+        memory_call = _start_memory_trace() if _instrumentation['trace_memory'] and depth == 0 else None
+        record = {'function': func.__name__, 'depth': depth, 'timestamp': time.time(),
+                  'input_rows': input_rows, 'input_columns': input_columns, 'output_rows': None,
+                  'output_columns': None, 'error': None}
+        _instrumentation_depth.value = depth + 1
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        try:
+            result = func(*args, **kwargs)
+            record['output_rows'], record['output_columns'] = _frame_shape(result)
+            return result
+        except Exception as e:
+            record['error'] = repr(e)
+            raise
+        finally:
+            record['wall_time'] = time.perf_counter() - wall_start
+            record['cpu_time'] = time.process_time() - cpu_start
+            _instrumentation_depth.value = depth
+            record['memory_peak_mb'] = _stop_memory_trace(memory_call) if memory_call is not None else None
+            record['peak_rss_mb'] = _peak_rss_mb()
+            for sink in _instrumentation['sinks']:
+                sink(record)
+
+    return wrapper
+
+
+def memory_sink(records:list=None):
+    """
+    Creates a sink which appends every instrumentation record to a list
+    :param records: List to append to, a new list is created if not given
+    :return: Sink, the list is available as its records attribute
+    """
+    if records is None:
+        records = []
+
+    def sink(record):
+        records.append(record)
+
+    sink.records = records
+    return sink
+
+
+def json_lines_sink(filepath:str):
+    """
+    Creates a sink which appends every instrumentation record as a line of JSON to a file
+    :param filepath: Path of the file
+    :return: Sink
+    """
+    def sink(record):
+        with open(filepath, 'a') as f:
+            f.write(json.dumps(record, default=str) + '\n')
+
+    return sink
+
+
+def logging_sink(logger:logging.Logger=None, level:int=logging.INFO):
+    """
+    Creates a sink which logs every instrumentation record
+    :param logger: Logger to use, defaults to the logger of this module
+    :param level: Logging level
+    :return: Sink
+    """
+    if logger is None:
+        logger = logging.getLogger(__name__)
+
+    def sink(record):
+        logger.log(level, '%s took %.4fs wall %.4fs cpu, rows %s -> %s', record['function'], record['wall_time'],
+                   record['cpu_time'], record['input_rows'], record['output_rows'])
+
+    return sink
+
+
+def enable_instrumentation(sinks:list=None, trace_memory:bool=False):
+    """
+    Starts measuring the wall time, CPU time, peak RSS and the Dataframe shapes of every call of a public function of
+    this module
+    :param sinks: List of sinks receiving the record of every call, defaults to a memory_sink
+    :param trace_memory: Indicating whether to trace the allocations of each outermost call with tracemalloc, which
+        slows the calls down. The peak of a call running at the same time as another traced call, e.g. in another
+        thread, is None
+    :return: The list of sinks in use
+
+    >>> sink = enable_instrumentation()[0]
+    >>> _ = replace_placeholders(pd.DataFrame({'a': ['...']}))
+    >>> disable_instrumentation()
+    >>> [(record['function'], record['input_rows'], record['output_columns']) for record in sink.records]
+    [('replace_placeholders', 1, 1)]
+    """
+    if sinks is None:
+        sinks = [memory_sink()]
+    _instrumentation.update({'enabled': True, 'sinks': list(sinks), 'trace_memory': trace_memory})
+    _instrumentation_depth.value = 0
+    return _instrumentation['sinks']
+
+
+def disable_instrumentation() -> None:
+    """
+    Stops measuring the calls of the functions of this module
+    :return: None
+    """
+    _instrumentation.update({'enabled': False, 'sinks': [], 'trace_memory': False})
+    _instrumentation_depth.value = 0
+
+
+def instrumentation_summary(records:list) -> pd.DataFrame:
+    """
+    Summarizes instrumentation records per function
+    :param records: List of records, e.g. the records of a memory_sink
+    :return: Dataframe containing the number of calls, the total and mean times and the peak memory of each function
+    """
+    df = pd.DataFrame(records, columns=['function', 'wall_time', 'cpu_time', 'memory_peak_mb', 'peak_rss_mb',
+                                        'input_rows', 'output_rows'])
+    summary = df.groupby('function').agg(calls=('wall_time', 'size'),
+                                         total_wall_time=('wall_time', 'sum'),
+                                         mean_wall_time=('wall_time', 'mean'),
+                                         total_cpu_time=('cpu_time', 'sum'),
+                                         memory_peak_mb=('memory_peak_mb', 'max'),
+                                         peak_rss_mb=('peak_rss_mb', 'max'),
+                                         max_input_rows=('input_rows', 'max'),
+                                         max_output_rows=('output_rows', 'max'))
+    return summary.sort_values('total_wall_time', ascending=False)
+
+
+_NOT_INSTRUMENTED = {'memory_sink', 'json_lines_sink', 'logging_sink', 'enable_instrumentation',
+                     'disable_instrumentation', 'instrumentation_summary'}
+for _name, _func in list(globals().items()):
+    if inspect.isfunction(_func) and _func.__module__ == __name__ and not _name.startswith('_') and \
+            _name not in _NOT_INSTRUMENTED:
+        globals()[_name] = _instrument(_func)
+PLOT_FUNCTIONS = {plot: globals()[func.__name__] for plot, func in PLOT_FUNCTIONS.items()}
@@ -0,0 +1,377 @@
+"""
+Local HTTP/JSON service answering analysis queries on a consolidated Dataframe kept in memory
+
+    python service.py --port 8765
+    curl 'http://127.0.0.1:8765/percent_change?countries=Libya&columns=mortality_all_gender'
+    curl -X POST 'http://127.0.0.1:8765/reload'
+
+List parameters are given by repeating the key, e.g. countries=Libya&countries=Iraq, and correlation pairs as x:y.
+The dataset is built with run_pipeline, so a reload only rebuilds the stages of the files which changed. Reloads run
+in a background thread while the previous dataset keeps answering queries.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import threading
+from collections import OrderedDict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+import pandas as pd
+from functions import *
+
+DEFAULT_PORT = 8765
+DEFAULT_CACHE_SIZE = 256
+DEFAULT_POLL_SECONDS = 5.0
+DEFAULT_CONFIG = {
+    'events': 'data/events_table.xlsx',
+    'countries': ['Iraq', 'Myanmar', 'Afghanistan', 'Libya', 'Germany', 'Venezuela'],
+    'stat2_names': [],
+    'manifest': [{'filepath': 'data/{}.xlsx'.format(filename), 'df_name': df_name} for filename, df_name in [
+        ('WPP2019_MORT_F03_1_DEATHS_BOTH_SEXES', 'mortality_all_gender'),
+        ('WPP2019_MORT_F03_2_DEATHS_MALE', 'mortality_male'),
+        ('WPP2019_MORT_F03_3_DEATHS_FEMALE', 'mortality_female'),
+        ('WPP2019_MORT_F07_1_LIFE_EXPECTANCY_0_BOTH_SEXES', 'life_expectancy_all_gender'),
+        ('WPP2019_MORT_F07_2_LIFE_EXPECTANCY_0_MALE', 'life_expectancy_male'),
+        ('WPP2019_MORT_F07_3_LIFE_EXPECTANCY_0_FEMALE', 'life_expectancy_female'),
+        ('WPP2019_MORT_F08_1_Q0040_BOTH_SEXES', 'mortality_b40_all_gender'),
+        ('WPP2019_MORT_F08_2_Q0040_MALE', 'mortality_b40_male'),
+        ('WPP2019_MORT_F08_3_Q0040_FEMALE', 'mortality_b40_female'),
+        ('WPP2019_MORT_F09_1_Q0060_BOTH_SEXES', 'mortality_b60_all_gender'),
+        ('WPP2019_MORT_F09_2_Q0060_MALE', 'mortality_b60_male'),
+        ('WPP2019_MORT_F09_3_Q0060_FEMALE', 'mortality_b60_female'),
+        ('WPP2019_MORT_F14_1_LIFE_EXPECTANCY_80_BOTH_SEXES', 'mortality_b80_all_gender'),
+        ('WPP2019_MORT_F14_2_LIFE_EXPECTANCY_80_MALE', 'mortality_b80_male'),
+        ('WPP2019_MORT_F14_3_LIFE_EXPECTANCY_80_FEMALE', 'mortality_b80_female'),
+        ('WPP2019_MIGR_F02_NET_NUMBER_OF_MIGRANTS', 'migration'),
+        ('WPP2019_FERT_F08_MEAN_AGE_CHILDBEARING', 'mean_childbearing_age')]]}
+
+logger = logging.getLogger('service')
+
+
+def data_fingerprint(config:dict) -> tuple:
+    """
+    Returns the modification time and size of every file of a configuration, to detect changes of the data
+
+    :param dict config: Configuration with the manifest and the events table
+    :return: Tuple of (path, modification time, size) of every file, None for the missing ones
+    """
+    fingerprint = []
+    for path in [entry['filepath'] for entry in config['manifest']] + [config['events']]:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+def load_state(config:dict) -> dict:
+    """
+    Builds the consolidated Dataframe of a configuration with run_pipeline, along with its country store and event index
+
+    :param dict config: Configuration with the manifest, the events table, the countries and optionally stat2_names,
+        the pipeline cache_dir and stream to only read the rows of the countries from the workbooks
+    :return: Dictionary containing the consolidated Dataframe, the store, the event index and the data fingerprint
+    """
+    fingerprint = data_fingerprint(config)
+    stages = build_pipeline(config['manifest'], config['events'], config['countries'],
+                            stat2_names=config.get('stat2_names', ()), stream=config.get('stream', False))
+    consolidated_df = run_pipeline(stages, targets=['consolidated'], cache_dir=config.get('cache_dir'),
+                                   verbose=False)['consolidated']
+    store = build_country_store(consolidated_df)
+    return {'consolidated': consolidated_df, 'store': store, 'event_index': build_event_index(store),
+            'fingerprint': fingerprint, 'loaded_at': time.time()}
+
+
+def _param(params:dict, name:str, default=None, required:bool=False):
+    """
+    Returns the last value of a query parameter
+
+    :param dict params: Query parameters parsed by parse_qs
+    :param str name: Name of the parameter
+    :param default: Value returned when the parameter is not given
+    :param bool required: Indicating whether to raise a ValueError when the parameter is not given
+    :return: Value of the parameter
+
+    >>> _param({'country': ['Libya']}, 'country')
+    'Libya'
+    """
+    if name not in params:
+        if required:
+            raise ValueError('Missing parameter : {}'.format(name))
+        return default
+    return params[name][-1]
+
+
+def _list_param(params:dict, name:str, default:list=None, required:bool=False) -> list:
+    """
+    Returns all the values of a repeated query parameter
+
+    :param dict params: Query parameters parsed by parse_qs
+    :param str name: Name of the parameter
+    :param list default: Value returned when the parameter is not given
+    :param bool required: Indicating whether to raise a ValueError when the parameter is not given
+    :return: List of values
+    """
+    if name not in params:
+        if required:
+            raise ValueError('Missing parameter : {}'.format(name))
+        return default
+    return params[name]
+
+
+def _frame_rows(df:pd.DataFrame) -> list:
+    """
+    Converts a Dataframe into a list of records, the index and multi-level columns are flattened into columns
+
+    :param pd.DataFrame df: Dataframe
+    :return: List of dictionaries, NaN become None
+    """
+    if not isinstance(df.index, pd.RangeIndex):
+        df = df.reset_index()
+    if isinstance(df.columns, pd.MultiIndex):
+        df.columns = [' '.join(str(level) for level in column if level != '') for column in df.columns]
+    return json.loads(df.to_json(orient='records'))
+
+
+def _country_query(state:dict, params:dict) -> list:
+    """
+    Rows of a country, optionally limited to the label columns and the given columns
+    """
+    country_df = get_country_frame(state['store'], _param(params, 'country', required=True))
+    columns = _list_param(params, 'columns')
+    if columns is not None:
+        country_df = country_df[list(country_df.columns[:6]) + [c for c in columns if c not in country_df.columns[:6]]]
+    return _frame_rows(country_df)
+
+
+def _percent_change_query(state:dict, params:dict) -> list:
+    """
+    Percent changes around the events of the given countries, see calculate_percent_change
+    """
+    columns = _list_param(params, 'columns', required=True)
+    return _frame_rows(calculate_percent_change(state['store'], _list_param(params, 'countries', required=True),
+                                                _list_param(params, 'level_two', columns), columns,
+                                                _param(params, 'level_two_name', 'Indicator'),
+                                                _param(params, 'pre_name', 'Pre'), _param(params, 'post_name', 'Post')))
+
+
+def _event_changes_query(state:dict, params:dict) -> list:
+    """
+    Changes from the period before to the period after every event, see calculate_event_changes
+    """
+    return _frame_rows(calculate_event_changes(state['store'], _list_param(params, 'columns', required=True),
+                                               _list_param(params, 'countries')))
+
+
+def _correlations_query(state:dict, params:dict) -> list:
+    """
+    Correlations of pairs of columns, optionally limited to the given countries, see calculate_correlations
+    """
+    countries = _list_param(params, 'countries')
+    data = state['store'] if countries is None else get_country_frame(state['store'], countries)
+    pairs = _list_param(params, 'pairs')
+    if pairs is not None:
+        pairs = [tuple(pair.split(':', 1)) for pair in pairs]
+        if any(len(pair) != 2 for pair in pairs):
+            raise ValueError('Pairs must be given as x:y')
+    return _frame_rows(calculate_correlations(data, pairs, _list_param(params, 'columns'),
+                                              _list_param(params, 'methods'),
+                                              [int(lag) for lag in _list_param(params, 'lags', ['0'])],
+                                              _param(params, 'split_events', '0') in ('1', 'true'),
+                                              int(_param(params, 'min_periods', 3))))
+
+
+def _events_query(state:dict, params:dict) -> list:
+    """
+    Events of a country from the event index
+    """
+    periods, events, years = get_country_events(state['event_index'], _param(params, 'country', required=True))
+    return [{'Period': period, 'Event': event, 'Year': year} for period, event, year in zip(periods, events, years)]
+
+
+def _countries_query(state:dict, params:dict) -> list:
+    """
+    Names of the countries of the dataset
+    """
+    return sorted(state['store']['slices'])
+
+
+QUERIES = {'/countries': _countries_query,
+           '/country': _country_query,
+           '/events': _events_query,
+           '/percent_change': _percent_change_query,
+           '/event_changes': _event_changes_query,
+           '/correlations': _correlations_query}
+
+
+def create_service(config:dict, cache_size:int=DEFAULT_CACHE_SIZE) -> dict:
+    """
+    Creates a service and loads its dataset
+
+    :param dict config: Configuration passed to load_state
+    :param int cache_size: Maximum number of cached responses
+    :return: Dictionary holding the state of the service
+    """
+    return {'config': config, 'state': load_state(config), 'version': 1, 'lock': threading.Lock(),
+            'cache': OrderedDict(), 'cache_size': cache_size, 'reloading': False, 'error': None,
+            'stop': threading.Event()}
+
+
+def answer(service:dict, path:str, params:dict) -> (int, bytes, bool):
+    """
+    Answers a query with the current dataset, responses are cached until the next reload
+
+    :param dict service: Service created by create_service
+    :param str path: Path of the query, one of QUERIES or /health
+    :param dict params: Query parameters parsed by parse_qs
+    :return: HTTP status, JSON body and whether the body came from the cache
+    """
+    if path == '/health':
+        state = service['state']
+        return 200, json.dumps({'version': service['version'], 'loaded_at': state['loaded_at'],
+                                'rows': len(state['consolidated']), 'reloading': service['reloading'],
+                                'error': service['error']}).encode(), False
+    if path not in QUERIES:
+        return 404, json.dumps({'error': 'Unknown query : {}'.format(path)}).encode(), False
+    with service['lock']:
+        state, version = service['state'], service['version']
+        key = (version, path, tuple(sorted((name, tuple(values)) for name, values in params.items())))
+        if key in service['cache']:
+            service['cache'].move_to_end(key)
+            return 200, service['cache'][key], True
+    try:
+        body = json.dumps({'version': version, 'result': QUERIES[path](state, params)}).encode()
+    except (KeyError, ValueError, TypeError) as e:
+        return 400, json.dumps({'error': '{} : {}'.format(type(e).__name__, e)}).encode(), False
+    with service['lock']:
+        if version == service['version']:
+            service['cache'][key] = body
+            while len(service['cache']) > service['cache_size']:
+                service['cache'].popitem(last=False)
+    return 200, body, False
+
+
+def start_reload(service:dict) -> bool:
+    """
+    Rebuilds the dataset in a background thread, queries are answered with the previous dataset until it is ready
+
+    :param dict service: Service created by create_service
+    :return: False if a reload is already running
+    """
+    with service['lock']:
+        if service['reloading']:
+            return False
+        service['reloading'] = True
+
+    def reload():
+        try:
+            state = load_state(service['config'])
+        except Exception as e:
+            logger.exception('Reload failed, keeping version %s', service['version'])
+            with service['lock']:
+                service['reloading'], service['error'] = False, '{} : {}'.format(type(e).__name__, e)
+            return
+        with service['lock']:
+            service['state'], service['version'] = state, service['version'] + 1
+            service['cache'].clear()
+            service['reloading'], service['error'] = False, None
+        logger.info('Reloaded dataset, version %s', service['version'])
+
+    threading.Thread(target=reload, name='reload', daemon=True).start()
+    return True
+
+
+def watch_data(service:dict, interval:float=DEFAULT_POLL_SECONDS) -> threading.Thread:
+    """
+    Starts a thread which reloads the dataset in the background when one of its files changes
+
+    :param dict service: Service created by create_service
+    :param float interval: Seconds between two checks of the files
+    :return: The watching thread, stopped by setting service['stop']
+    """
+    def watch():
+        while not service['stop'].wait(interval):
+            if data_fingerprint(service['config']) != service['state']['fingerprint'] and start_reload(service):
+                logger.info('Data files changed, reloading')
+
+    thread = threading.Thread(target=watch, name='watch', daemon=True)
+    thread.start()
+    return thread
+
+
+def make_handler(service:dict) -> type:
+    """
+    Creates the request handler class of a service
+
+    :param dict service: Service created by create_service
+    :return: Subclass of BaseHTTPRequestHandler
+    """
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, status:int, body:bytes, cached:bool=False) -> None:
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('X-Cache', 'hit' if cached else 'miss')
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self) -> None:
+            url = urlsplit(self.path)
+            self._send(*answer(service, url.path, parse_qs(url.query)))
+
+        def do_POST(self) -> None:
+            if urlsplit(self.path).path != '/reload':
+                self._send(404, json.dumps({'error': 'Unknown command : {}'.format(self.path)}).encode())
+                return
+            started = start_reload(service)
+            self._send(202, json.dumps({'reloading': True, 'started': started}).encode())
+
+        def log_message(self, format:str, *args) -> None:
+            logger.info('%s %s', self.address_string(), format % args)
+
+    return Handler
+
+
+def main(argv:list=None) -> int:
+    """
+    Runs the service from the command line
+
+    :param list argv: Command line arguments
+    :return: Exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=DEFAULT_PORT)
+    parser.add_argument('--config', help='JSON file with the manifest, events, countries and stat2_names')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE)
+    parser.add_argument('--poll', type=float, default=DEFAULT_POLL_SECONDS,
+                        help='Seconds between checks of the data files, 0 disables the background reload')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    config = DEFAULT_CONFIG
+    if args.config:
+        with open(args.config) as f:
+            config = dict(DEFAULT_CONFIG, **json.load(f))
+    start = time.perf_counter()
+    service = create_service(config, args.cache_size)
+    logger.info('Loaded %s rows in %.1f s', len(service['state']['consolidated']), time.perf_counter() - start)
+    if args.poll > 0:
+        watch_data(service, args.poll)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(service))
+    logger.info('Serving on http://%s:%s', args.host, server.server_address[1])
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service['stop'].set()
+        server.server_close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())